@@ -6,7 +6,7 @@ from django.utils.translation import gettext_lazy as _, ngettext
 
 from commonstuff.filters import MyDateListFilterNoFuture, MyDateListFilter
 
-from .models import DigestSubscription, Task
+from .models import DigestSubscription, Task, TimezoneSubscribers
 from .forms import TaskAdminForm
 from .filters import IsDoneFilter
 
@@ -112,5 +112,17 @@ class TaskAdmin(admin.ModelAdmin):
     activate_tasks.short_description = _('Activate selected tasks')
 
 
+class TimezoneSubscribersAdmin(admin.ModelAdmin):
+    """Active subscribers distribution by timezone (read only)"""
+    list_display = ('timezone', 'active',)
+    search_fields = ('timezone',)
+    list_per_page = 100
+    ordering = ('-active',)
+    has_add_permission = lambda self, request: False
+    has_change_permission = lambda self, request, obj=None: False
+    has_delete_permission = lambda self, request, obj=None: False
+
+
 admin.site.register(Task, TaskAdmin)
 admin.site.register(DigestSubscription, DigestSubscriptionAdmin)
+admin.site.register(TimezoneSubscribers, TimezoneSubscribersAdmin)
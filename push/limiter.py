@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value, now=None):
+    """
+    Retry-After header (delay in seconds or HTTP-date) to unix timestamp.
+    Returns None if there is no header or it can't be parsed.
+    """
+    if not value:
+        return None
+    if now is None:
+        now = time.time()
+    try:
+        return now + max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class _OriginState(object):
+    __slots__ = ('tokens', 'updated_at', 'paused_until', 'failures',)
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.paused_until = 0
+        self.failures = 0  # consecutive
+
+
+class OriginLimiter(object):
+    """
+    Push service (origin) guard for a pushsend worker process:
+
+    * token bucket rate limiter (rate requests per second, 0 - no limit),
+    * honors Retry-After of 429 and 503 responses,
+    * circuit breaker: after breaker_errors consecutive 5xx responses
+      (or connection errors) origin is paused for breaker_pause seconds,
+      the first error after the pause opens it again.
+
+    Requests to origin paused for longer than max_wait seconds should be
+    deferred, not waited for.
+    """
+
+    def __init__(self, rate=0, breaker_errors=50, breaker_pause=60, max_wait=5):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)  # one second burst
+        self.breaker_errors = breaker_errors
+        self.breaker_pause = breaker_pause
+        self.max_wait = max_wait
+        self._origins = {}
+
+    def _state(self, origin, now):
+        try:
+            return self._origins[origin]
+        except KeyError:
+            state = self._origins[origin] = _OriginState(self.capacity, now)
+            return state
+
+    def paused_until(self, origin):
+        try:
+            return self._origins[origin].paused_until
+        except KeyError:
+            return 0
+
+    def delay(self, origin, now=None):
+        """
+        Takes a token for the next request to origin and returns how many
+        seconds to wait before sending it. None means origin is paused
+        for too long and request should be deferred.
+        """
+        if now is None:
+            now = time.time()
+        state = self._state(origin, now)
+        wait = max(0, state.paused_until - now)
+        if wait > self.max_wait:
+            return None
+        if self.rate:
+            state.tokens = min(
+                self.capacity,
+                state.tokens + (now - state.updated_at) * self.rate
+            )
+            state.updated_at = now
+            # negative tokens are requests already waiting for their turn
+            state.tokens -= 1
+            if state.tokens < 0:
+                wait = max(wait, -state.tokens / self.rate)
+        return wait
+
+    def response(self, origin, status_code, headers=None, now=None):
+        """Learn from push service response"""
+        if now is None:
+            now = time.time()
+        state = self._state(origin, now)
+        if status_code in (429, 503) and headers is not None:
+            retry_at = parse_retry_after(headers.get('retry-after'), now)
+            if retry_at is not None:
+                state.paused_until = max(state.paused_until, retry_at)
+        if status_code >= 500:
+            self.failure(origin, now)
+        else:
+            state.failures = 0
+
+    def failure(self, origin, now=None):
+        """5xx response or connection error"""
+        if now is None:
+            now = time.time()
+        state = self._state(origin, now)
+        state.failures += 1
+        if state.failures >= self.breaker_errors:
+            state.paused_until = max(state.paused_until, now + self.breaker_pause)
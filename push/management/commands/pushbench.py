@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+import os
+import ssl
+import base64
+import json
+import time
+import random
+import asyncio
+import datetime
+import tempfile
+import resource
+import threading
+import ipaddress
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from django.conf import settings
+from django.test.utils import override_settings
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from push.models import DigestSubscription, Task, TimezoneSubscribers
+from push.sender import ENGINES, httpx
+from push.settings import PUSHSEND_ENGINE, VAPID_PRIVATE_KEY, SAVE_QUEUE, CACHE
+from push.management.commands.pushsend import Command as PushsendCommand
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:  # optional, only needed for --http2
+    h2 = None
+
+
+class FakePushService(object):
+    """
+    Local stand-in for a push service: answers every push after a random
+    delay (around latency seconds) with 201, or with 500, 410 or 429 (with
+    Retry-After) for errors, gone and throttled fractions of requests.
+    
+    Speaks HTTP/1.1 with keep-alive, or HTTP/2 over TLS with a self-signed
+    certificate (cert_file) for http2=True.
+    """
+    
+    def __init__(self, latency=0.05, errors=0.0, gone=0.0, throttled=0.0,
+                 http2=False, seed=None):
+        self.latency = latency
+        self.errors = errors
+        self.gone = gone
+        self.throttled = throttled
+        self.http2 = http2
+        self.random = random.Random(seed)
+        self.responses = Counter()
+        self.origin = None
+        self.cert_file = None
+        self._lock = threading.Lock()
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._tmp_dir = None
+    
+    def outcome(self):
+        """(status code, headers, delay) of the next response"""
+        with self._lock:
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+            r = self.random.random()
+            if r < self.errors:
+                status, headers = 500, []
+            elif r < self.errors + self.gone:
+                status, headers = 410, []
+            elif r < self.errors + self.gone + self.throttled:
+                status, headers = 429, [('retry-after', '1')]
+            else:
+                status, headers = 201, []
+            self.responses[status] += 1
+        return (status, headers, delay)
+    
+    def start(self):
+        if self.http2:
+            self._start_http2()
+        else:
+            self._start_http1()
+        self._thread.start()
+        return self.origin
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+    
+    def _start_http1(self):
+        service = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('content-length') or 0))
+                status, headers, delay = service.outcome()
+                time.sleep(delay)
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('content-length', '0')
+                self.end_headers()
+            
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('content-length', '0')
+                self.end_headers()
+            
+            def log_message(self, *args):
+                pass
+        
+        self._server = _HTTPServer(('127.0.0.1', 0), Handler)
+        self.origin = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    
+    def _start_http2(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.cert_file, key_file = self._self_signed_cert(self._tmp_dir.name)
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(self.cert_file, key_file)
+        ssl_context.set_alpn_protocols(['h2'])
+        
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(self._loop.create_server(
+            lambda: _H2Protocol(self), '127.0.0.1', 0, ssl=ssl_context
+        ))
+        self.origin = "https://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+        
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_forever()
+            server.close()
+            self._loop.run_until_complete(server.wait_closed())
+            self._loop.close()
+        
+        self._thread = threading.Thread(target=serve, daemon=True)
+    
+    @staticmethod
+    def _self_signed_cert(dir_name):
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+        now = datetime.datetime.utcnow()
+        cert = x509.CertificateBuilder() \
+            .subject_name(name).issuer_name(name) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=1)) \
+            .add_extension(x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]
+            ), critical=False) \
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+            .sign(key, hashes.SHA256())
+        cert_file = os.path.join(dir_name, 'cert.pem')
+        key_file = os.path.join(dir_name, 'key.pem')
+        with open(cert_file, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_file, 'wb') as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ))
+        return (cert_file, key_file)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # async engine opens a lot of connections at once
+    request_queue_size = 1024
+
+
+class _H2Protocol(asyncio.Protocol):
+    """HTTP/2 connection of FakePushService"""
+    
+    def __init__(self, service):
+        self.service = service
+        self.transport = None
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False)
+        )
+        self.warm_ups = set()  # HEAD requests' stream ids
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+    
+    def data_received(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                if (b':method', b'HEAD') in event.headers:
+                    self.warm_ups.add(event.stream_id)
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+    
+    async def respond(self, stream_id):
+        if stream_id in self.warm_ups:
+            self.warm_ups.discard(stream_id)
+            status, headers, delay = (200, [], 0)
+        else:
+            status, headers, delay = self.service.outcome()
+        await asyncio.sleep(delay)
+        if self.transport.is_closing():
+            return
+        try:
+            self.conn.send_headers(
+                stream_id,
+                [(':status', str(status)), ('content-length', '0')] + headers,
+                end_stream=True
+            )
+        except h2.exceptions.StreamClosedError:
+            return  # client gave up on it
+        self.transport.write(self.conn.data_to_send())
+
+
+def percentile(sorted_values, q):
+    """Nearest rank percentile (q from 0 to 1) of sorted list, None if empty"""
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+
+class BenchPushsend(PushsendCommand):
+    """pushsend that remembers every push service response time"""
+    
+    latencies = None
+    origin = None
+    
+    def prewarm(self):
+        # real push services have nothing to do with the benchmark
+        return super(BenchPushsend, self).prewarm([self.origin])
+    
+    def account_results(self, responses, exceptions):
+        self.latencies.extend(
+            r.elapsed for s, r in responses if r.elapsed is not None
+        )
+        return super(BenchPushsend, self).account_results(responses, exceptions)
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks pushsend against a local fake push service in a throwaway
+    test database, so no real subscriber ever gets the push.
+    """
+    
+    help = 'Measures pushsend throughput with a local fake push service'
+    
+    DB_LIMIT = 5000  # subscriptions to DB at a time
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--subscriptions', type=int, default=10000,
+            help='How many subscriptions to send to (default 10000).'
+        )
+        parser.add_argument(
+            '--engine', action='append', choices=sorted(ENGINES),
+            help='pushsend engine, repeat it to compare engines '
+                 '(default is DJANGO_INFOPUSH_PUSHSEND_ENGINE).'
+        )
+        parser.add_argument(
+            '--http2', action='store_true',
+            help='Fake push service speaks HTTP/2 over TLS (async engine only).'
+        )
+        parser.add_argument(
+            '--latency', type=float, default=0.05,
+            help='Average push service response time, seconds (default 0.05).'
+        )
+        parser.add_argument(
+            '--errors', type=float, default=0.0,
+            help='Fraction of 500 responses (default 0).'
+        )
+        parser.add_argument(
+            '--gone', type=float, default=0.0,
+            help='Fraction of 410 responses (default 0).'
+        )
+        parser.add_argument(
+            '--throttled', type=float, default=0.0,
+            help='Fraction of 429 responses with Retry-After (default 0).'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed of fake push service responses.'
+        )
+        parser.add_argument(
+            '--json', dest='json_path', default=None,
+            help='Save results to JSON file (to use it as a baseline later).'
+        )
+        parser.add_argument(
+            '--baseline', default=None,
+            help='JSON file of an earlier benchmark to compare results with.'
+        )
+        parser.add_argument(
+            '--noinput', '--no-input', action='store_false', dest='interactive',
+            help='Delete leftover benchmark database without asking.'
+        )
+    
+    def handle(self, *args, **options):
+        engines = options['engine'] or [PUSHSEND_ENGINE]
+        if 'async' in engines and httpx is None:
+            raise CommandError("Async pushsend engine needs httpx[http2] installed.")
+        if options['http2']:
+            if h2 is None:
+                raise CommandError("HTTP/2 fake push service needs h2 installed.")
+            if set(engines) != {'async'}:
+                raise CommandError("Only async pushsend engine speaks HTTP/2.")
+        if not VAPID_PRIVATE_KEY:
+            raise CommandError("pushbench needs DJANGO_INFOPUSH_VAPID_PRIVATE_KEY.")
+        if SAVE_QUEUE:
+            # pushsend would move queued subscriptions to benchmark database
+            raise CommandError("Turn DJANGO_INFOPUSH_SAVE_QUEUE off to run pushbench.")
+        if not 0 <= options['errors'] + options['gone'] + options['throttled'] <= 1:
+            raise CommandError("--errors, --gone and --throttled must add up to 1 at most.")
+        
+        service = FakePushService(
+            latency=options['latency'], errors=options['errors'],
+            gone=options['gone'], throttled=options['throttled'],
+            http2=options['http2'], seed=options['seed']
+        )
+        old_db_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options['interactive'], serialize=False
+        )
+        service.start()
+        old_cert_file = os.environ.get('SSL_CERT_FILE')
+        if service.cert_file:
+            # pushsend workers (forked later) trust fake push service certificate
+            os.environ['SSL_CERT_FILE'] = service.cert_file
+        # payload cache, wakeup and stats keys of the benchmark stay away
+        # from the project's cache
+        caches_override = override_settings(CACHES=dict(settings.CACHES, **{
+            CACHE: {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'pushbench',
+            }
+        }))
+        try:
+            results = []
+            with caches_override:
+                for engine in engines:
+                    self.seed(service.origin, options['subscriptions'])
+                    results.append(self.run(engine, service))
+        finally:
+            if service.cert_file:
+                if old_cert_file is None:
+                    os.environ.pop('SSL_CERT_FILE', None)
+                else:
+                    os.environ['SSL_CERT_FILE'] = old_cert_file
+            service.stop()
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        
+        report = {
+            'subscriptions': options['subscriptions'],
+            'http2': options['http2'],
+            'latency': options['latency'],
+            'errors': options['errors'],
+            'gone': options['gone'],
+            'throttled': options['throttled'],
+            'runs': results,
+        }
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = { r['engine']: r for r in json.load(f)['runs'] }
+        for result in results:
+            self.print_result(result, (baseline or {}).get(result['engine']))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as f:
+                json.dump(report, f, indent=2)
+    
+    def seed(self, origin, quantity):
+        """Fresh active subscriptions of fake push service and a due task"""
+        DigestSubscription.objects.all().delete()
+        Task.objects.all().delete()
+        
+        # one browser-like key pair for everybody, payload encryption
+        # still costs as much as it does for real subscriptions
+        public_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+        p256dh = public_key.public_bytes(
+            serialization.Encoding.X962,
+            serialization.PublicFormat.UncompressedPoint
+        )
+        b64 = lambda b: base64.urlsafe_b64encode(b).strip(b'=').decode('utf8')
+        key, auth_secret = b64(p256dh), b64(os.urandom(16))
+        now = timezone.now()
+        
+        for i in range(0, quantity, self.DB_LIMIT):
+            subscriptions = []
+            for n in range(i, min(quantity, i + self.DB_LIMIT)):
+                endpoint = "%s/wpush/bench/%d" % (origin, n)
+                subscriptions.append(DigestSubscription(
+                    endpoint=endpoint,
+                    endpoint_hash=DigestSubscription.hash_endpoint(endpoint),
+                    key=key, auth_secret=auth_secret, ua='pushbench',
+                    timezone=settings.TIME_ZONE, is_active=True, activated_at=now
+                ))
+            DigestSubscription.objects.bulk_create(subscriptions)
+        TimezoneSubscribers.recount()
+        
+        Task.objects.create(
+            title='pushbench', message='pushbench', url='https://example.com/',
+            is_active=True, run_at=now - datetime.timedelta(days=2)
+        )
+    
+    def run(self, engine, service):
+        service.responses.clear()
+        queries = [0]
+        
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+        
+        cmd = BenchPushsend()
+        cmd.latencies = []
+        cmd.origin = service.origin
+        with connection.execute_wrapper(count_queries):
+            started_at = time.time()
+            call_command(cmd, engine=engine, stdout=self.stdout)
+            seconds = time.time() - started_at
+        latencies = sorted(cmd.latencies)
+        phases = dict(cmd.metrics.phases)
+        failed = cmd.metrics.pushes
+        del cmd  # frees pushsend lock
+        
+        # maximum over the lifetime of benchmark process (and it's
+        # finished children: pushsend worker pool), in kilobytes on linux
+        rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        
+        pushes = sum(service.responses.values())
+        return {
+            'engine': engine,
+            'seconds': round(seconds, 3),
+            'pushes': pushes,
+            'sends_per_second': round(pushes / seconds, 1) if seconds else 0.0,
+            'responses': { str(k): v for k, v in sorted(service.responses.items()) },
+            'exceptions': failed['exception'],
+            'deferred': failed['deferred'],
+            'p50_latency': percentile(latencies, 0.5),
+            'p99_latency': percentile(latencies, 0.99),
+            'phases': { k: round(v, 3) for k, v in sorted(phases.items()) },
+            'queries': queries[0],
+            'peak_rss_kb': rss_self,
+            'peak_worker_rss_kb': rss_children,
+        }
+    
+    def print_result(self, result, baseline=None):
+        def fmt(name, value, template="%s"):
+            text = template % value if value is not None else "-"
+            if baseline and baseline.get(name) and value is not None:
+                text += " (%+.1f%%)" % ((value - baseline[name]) * 100.0 / baseline[name])
+            return text
+        
+        self.stdout.write("engine %s:" % result['engine'])
+        self.stdout.write("  pushes: %d in %.3f s, responses: %s" % (
+            result['pushes'], result['seconds'],
+            ", ".join( "%s %d" % r for r in result['responses'].items() )
+        ))
+        self.stdout.write("  exceptions: %d, deferred: %d" % (
+            result['exceptions'], result['deferred']
+        ))
+        self.stdout.write("  sends/sec: %s" % fmt('sends_per_second', result['sends_per_second'], "%.1f"))
+        self.stdout.write("  latency p50: %s, p99: %s" % (
+            fmt('p50_latency', result['p50_latency'], "%.3f s"),
+            fmt('p99_latency', result['p99_latency'], "%.3f s"),
+        ))
+        self.stdout.write("  phases: %s" % ", ".join(
+            "%s %.3f s" % p for p in result['phases'].items()
+        ))
+        self.stdout.write("  DB queries: %s" % fmt('queries', result['queries']))
+        self.stdout.write("  peak RSS: %s, workers: %s" % (
+            fmt('peak_rss_kb', result['peak_rss_kb'], "%d KB"),
+            fmt('peak_worker_rss_kb', result['peak_worker_rss_kb'], "%d KB"),
+        ))
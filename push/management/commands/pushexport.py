@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from push.models import DigestSubscription
+
+
+class Command(BaseCommand):
+    """Streams push subscriptions to CSV or JSON lines file"""
+    
+    help = 'Exports push subscriptions to CSV or JSON lines file (gzipped if needed)'
+    
+    FIELDS = ('id', 'endpoint', 'key', 'auth_secret', 'timezone', 'ua',
+              'is_active', 'errors', 'created_at', 'activated_at', 'deactivated_at',)
+    DB_LIMIT = 5000  # subscriptions from DB at a time
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='File to export to, "-" for stdout. Files ending with .gz are gzipped.'
+        )
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl',), default=None,
+            help='Default is by file extension (.jsonl or .csv), csv for stdout.'
+        )
+        parser.add_argument(
+            '--gzip', action='store_true',
+            help='Gzip the output even if file name does not end with .gz.'
+        )
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Export inactive subscriptions too.'
+        )
+    
+    def handle(self, *args, **options):
+        path = options['path']
+        use_gzip = options['gzip'] or path.endswith('.gz')
+        fmt = options['format']
+        if fmt is None:
+            name = path[:-3] if path.endswith('.gz') else path
+            fmt = 'jsonl' if name.endswith(('.jsonl', '.json',)) else 'csv'
+        
+        if path == '-':
+            out = gzip.open(sys.stdout.buffer, 'wt', encoding='utf8', newline='') \
+                if use_gzip else sys.stdout
+        elif use_gzip:
+            out = gzip.open(path, 'wt', encoding='utf8', newline='')
+        else:
+            out = open(path, 'w', encoding='utf8', newline='')
+        
+        try:
+            if fmt == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(self.FIELDS)
+                write = lambda row: writer.writerow(
+                    [ '' if v is None else int(v) if isinstance(v, bool) else v for v in row ]
+                )
+            else:
+                write = lambda row: out.write(json.dumps(
+                    dict(zip(self.FIELDS, row)), default=str
+                ) + '\n')
+            counter = 0
+            for row in self.rows(options['all']):
+                write(row)
+                counter += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        
+        self.stderr.write("%d subscriptions exported." % counter)
+    
+    def rows(self, with_inactive=False):
+        """
+        Subscription rows (tuples) by id ranges, so memory use does not depend
+        on table size on every db backend (mysqlclient buffers whole result
+        set even for a queryset iterator) and no long running cursor is needed.
+        """
+        qs = DigestSubscription.objects.all()
+        if not with_inactive:
+            qs = qs.filter(is_active=True)
+        last_id = 0
+        while True:
+            batch = list(
+                qs.filter(id__gt=last_id).order_by('id').values_list(*self.FIELDS)[:self.DB_LIMIT]
+            )
+            if not batch:
+                return
+            for row in batch:
+                yield row
+            last_id = batch[-1][0]
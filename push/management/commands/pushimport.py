@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import pytz
+
+import csv
+import gzip
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import URLValidator
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from push.models import DigestSubscription
+
+
+class Command(BaseCommand):
+    """Bulk import of push subscriptions (e.g. made by pushexport)"""
+    
+    help = 'Imports active push subscriptions from CSV or JSON lines file (may be gzipped)'
+    
+    FIELDS = ('key', 'auth_secret', 'timezone', 'ua',)
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='File to import, "-" for stdin. Files ending with .gz are gunzipped.'
+        )
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl',), default=None,
+            help='Default is by file extension (.jsonl or .csv), csv for stdin.'
+        )
+    
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format']
+        if fmt is None:
+            name = path[:-3] if path.endswith('.gz') else path
+            fmt = 'jsonl' if name.endswith(('.jsonl', '.json',)) else 'csv'
+        
+        try:
+            if path == '-':
+                f = sys.stdin
+            elif path.endswith('.gz'):
+                f = gzip.open(path, 'rt', encoding='utf8', newline='')
+            else:
+                f = open(path, 'r', encoding='utf8', newline='')
+        except OSError as e:
+            raise CommandError("Can't open %s: %s" % (path, e))
+        
+        self.url_validate = URLValidator(schemes=['https',])
+        imported = skipped = 0
+        chunk = []
+        try:
+            if fmt == 'csv':
+                rows = csv.DictReader(f)
+            else:
+                rows = ( json.loads(line) for line in f if line.strip() )
+            for row in rows:
+                item = self.item(row)
+                if item is None:
+                    skipped += 1
+                    continue
+                chunk.append(item)
+                if len(chunk) >= DigestSubscription.BULK_CHUNK:
+                    imported += DigestSubscription.bulk_upsert(chunk)
+                    chunk = []
+            if chunk:
+                imported += DigestSubscription.bulk_upsert(chunk)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        
+        self.stdout.write("%d subscriptions imported, %d skipped." % (imported, skipped))
+    
+    def item(self, row):
+        """bulk_upsert item for the row or None if it should be skipped"""
+        if str(row.get('is_active', True)).lower() in ('0', 'false', 'f',):
+            return None
+        endpoint = (row.get('endpoint') or '').strip()
+        try:
+            self.url_validate(endpoint)
+        except ValidationError:
+            return None
+        fields = { f: (row.get(f) or '').strip() for f in self.FIELDS }
+        if fields['timezone'] not in pytz.all_timezones_set:
+            return None
+        fields['ua'] = fields['ua'][:255]
+        return (endpoint, fields, timezone.now())
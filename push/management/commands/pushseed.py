@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import pytz
+
+import io
+import base64
+import json
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.urls import reverse
+from django.utils import timezone
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from push.models import DigestSubscription, Task, TimezoneLayout, TimezoneSubscribers
+from push.settings import ERROR_THRESHOLD
+
+
+CHROME_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 ' \
+            '(KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'
+ANDROID_UA = 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 ' \
+             '(KHTML, like Gecko) Chrome/118.0.0.0 Mobile Safari/537.36'
+FIREFOX_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:119.0) Gecko/20100101 Firefox/119.0'
+SAFARI_UA = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 ' \
+            '(KHTML, like Gecko) Version/17.0 Safari/605.1.15'
+EDGE_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 ' \
+          '(KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36 Edg/118.0.2088.76'
+
+# Default distribution spec, --spec JSON file overrides any of it's keys.
+# Weights are relative, fractions are from 0 to 1.
+DEFAULT_SPEC = {
+    # timezone: weight (project's TIME_ZONE is added with the biggest weight)
+    'timezones': {
+        'Europe/Moscow': 30, 'Europe/Kiev': 8, 'Europe/Minsk': 4,
+        'Asia/Yekaterinburg': 6, 'Asia/Novosibirsk': 4, 'Asia/Almaty': 3,
+        'Europe/Berlin': 5, 'Europe/London': 4, 'America/New_York': 5,
+        'America/Los_Angeles': 3, 'Asia/Tokyo': 2, 'Australia/Sydney': 1,
+    },
+    # endpoint prefix: weight and user agent of the browser
+    'origins': {
+        'https://fcm.googleapis.com/fcm/send/': {'weight': 62, 'ua': CHROME_UA},
+        'https://fcm.googleapis.com/wp/': {'weight': 10, 'ua': ANDROID_UA},
+        'https://updates.push.services.mozilla.com/wpush/v2/': {'weight': 18, 'ua': FIREFOX_UA},
+        'https://web.push.apple.com/': {'weight': 5, 'ua': SAFARI_UA},
+        'https://wns2-am3p.notify.windows.com/w/?token=': {'weight': 4, 'ua': EDGE_UA},
+        'https://android.googleapis.com/gcm/send/': {'weight': 1, 'ua': ANDROID_UA},
+    },
+    # subscriptions with p256dh key and auth secret (payload support)
+    'with_keys': 0.97,
+    # deactivated subscriptions
+    'inactive': 0.35,
+    # deactivated by send errors (ERROR_THRESHOLD reached), not by user
+    'inactive_by_errors': 0.6,
+    # send errors of active subscriptions: weight
+    'errors': {'0': 88, '1': 6, '2': 3, '5': 2, '15': 1},
+    # subscriptions were created during this many days
+    'max_age_days': 730,
+    # push tasks: already sent ones (a day apart) and due now
+    'tasks': {'done': 5, 'due': 1},
+}
+
+
+class Command(BaseCommand):
+    """
+    Synthetic push subscriptions (and tasks) for load testing: realistic
+    spread of timezones, push services, inactive subscriptions and send
+    errors, reproducible with the same --seed and --spec.
+    """
+    
+    help = 'Generates synthetic push subscriptions and tasks for load testing'
+    
+    DB_LIMIT = 5000  # subscriptions to DB at a time
+    KEYS = 64  # distinct key pairs (real ones, so payload can be encrypted)
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'count', type=int,
+            help='How many subscriptions to generate.'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed, the same seed makes the same dataset (default 0).'
+        )
+        parser.add_argument(
+            '--spec', default=None,
+            help='JSON file with distribution spec, overrides defaults by keys.'
+        )
+        parser.add_argument(
+            '--no-copy', action='store_false', dest='copy',
+            help='Use INSERT on PostgreSQL too (COPY is used by default).'
+        )
+    
+    def handle(self, *args, **options):
+        spec = dict(DEFAULT_SPEC)
+        spec['timezones'] = dict(spec['timezones'])
+        spec['timezones'].setdefault(settings.TIME_ZONE, 0)
+        spec['timezones'][settings.TIME_ZONE] += max(spec['timezones'].values()) + 10
+        if options['spec']:
+            with open(options['spec']) as f:
+                spec.update(json.load(f))
+        unknown = set(spec['timezones']) - pytz.all_timezones_set
+        if unknown:
+            raise CommandError("Unknown timezones in spec: %s" % ", ".join(sorted(unknown)))
+        
+        rnd = random.Random(options['seed'])
+        use_copy = options['copy'] and connection.vendor == 'postgresql'
+        counter = 0
+        with transaction.atomic():
+            for subscriptions in self.subscriptions(rnd, spec, options['count']):
+                if use_copy:
+                    self.copy(subscriptions)
+                else:
+                    DigestSubscription.objects.bulk_create(subscriptions)
+                counter += len(subscriptions)
+            # bulk inserts go around the counters
+            TimezoneSubscribers.recount()
+            tasks = self.tasks(rnd, spec['tasks'])
+        
+        self.stdout.write("%d subscriptions and %d tasks generated." % (counter, tasks))
+    
+    def subscriptions(self, rnd, spec, count):
+        """Generator of unsaved subscription lists (DB_LIMIT at most)"""
+        now = timezone.now()
+        timezones = Picker(spec['timezones'])
+        origins = Picker({ k: v['weight'] for k, v in spec['origins'].items() })
+        errors = Picker({ int(k): v for k, v in spec['errors'].items() })
+        keys = self.key_pairs(rnd)
+        max_age = spec['max_age_days'] * 86400
+        
+        for i in range(0, count, self.DB_LIMIT):
+            subscriptions = []
+            for n in range(i, min(count, i + self.DB_LIMIT)):
+                origin = origins.pick(rnd)
+                endpoint = origin + _b64(rnd.getrandbits(8 * 105).to_bytes(105, 'big'))
+                created_at = now - timedelta(seconds=rnd.randint(0, max_age))
+                s = DigestSubscription(
+                    endpoint=endpoint,
+                    endpoint_hash=DigestSubscription.hash_endpoint(endpoint),
+                    ua=spec['origins'][origin]['ua'],
+                    timezone=timezones.pick(rnd),
+                    created_at=created_at,
+                    activated_at=created_at,
+                )
+                if rnd.random() < spec['with_keys']:
+                    s.key = keys[rnd.randrange(len(keys))]
+                    s.auth_secret = _b64(rnd.getrandbits(128).to_bytes(16, 'big'))
+                if rnd.random() < spec['inactive']:
+                    s.is_active = False
+                    s.deactivated_at = created_at + (now - created_at) * rnd.random()
+                    if rnd.random() < spec['inactive_by_errors']:
+                        s.errors = ERROR_THRESHOLD
+                else:
+                    s.is_active = True
+                    s.errors = min(errors.pick(rnd), ERROR_THRESHOLD - 1)
+                subscriptions.append(s)
+            yield subscriptions
+    
+    def key_pairs(self, rnd):
+        """p256dh keys derived from seeded random numbers"""
+        keys = []
+        for i in range(self.KEYS):
+            private_key = ec.derive_private_key(rnd.getrandbits(255) | 1, ec.SECP256R1())
+            keys.append(_b64(private_key.public_key().public_bytes(
+                serialization.Encoding.X962,
+                serialization.PublicFormat.UncompressedPoint
+            )))
+        return keys
+    
+    def copy(self, subscriptions):
+        """PostgreSQL COPY of unsaved subscriptions (much faster than INSERT)"""
+        fields = [ f for f in DigestSubscription._meta.concrete_fields if not f.primary_key ]
+        lines = []
+        for s in subscriptions:
+            values = []
+            for f in fields:
+                value = f.get_db_prep_save(getattr(s, f.attname), connection)
+                if value is None:
+                    values.append('\\N')
+                elif isinstance(value, bool):
+                    values.append('t' if value else 'f')
+                else:
+                    values.append(str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+                                            .replace('\n', '\\n').replace('\r', '\\r'))
+            lines.append('\t'.join(values))
+        data = io.StringIO('\n'.join(lines) + '\n')
+        with connection.cursor() as cursor:
+            cursor.cursor.copy_expert(
+                'COPY %s (%s) FROM STDIN' % (
+                    connection.ops.quote_name(DigestSubscription._meta.db_table),
+                    ', '.join( connection.ops.quote_name(f.column) for f in fields )
+                ),
+                data
+            )
+    
+    def tasks(self, rnd, spec):
+        """
+        Push tasks with their timezone layouts: done ones, a day apart,
+        with views and clicks, and due ones (run at now).
+        Returns how many tasks were made.
+        """
+        now = timezone.now()
+        active = DigestSubscription.objects.filter(is_active=True).count()
+        url = 'https://' + Site.objects.get_current().domain + reverse('push_info_disable')
+        counter = 0
+        for i in range(spec.get('done', 0)):
+            run_at = now - timedelta(days=(spec['done'] - i))
+            task = Task.objects.create(
+                title="Synthetic task %d" % (counter + 1),
+                message="Synthetic push notification for load testing.",
+                url=url, is_active=True, run_at=run_at,
+            )
+            send_time = timedelta(minutes=rnd.randint(1, 30))
+            TimezoneLayout.objects.filter(task=task).update(
+                started_at=F('run_at'), done_at=(F('run_at') + send_time)
+            )
+            layouts = TimezoneLayout.objects.filter(task=task)
+            views = int(active * rnd.uniform(0.4, 0.7))
+            Task.objects.filter(pk=task.pk).update(
+                started_at=min( l.run_at for l in layouts ),
+                done_at=(max( l.run_at for l in layouts ) + send_time),
+                views=views,
+                clicks=int(views * rnd.uniform(0.01, 0.05)),
+                closings=int(views * rnd.uniform(0.1, 0.3)),
+            )
+            counter += 1
+        for i in range(spec.get('due', 0)):
+            Task.objects.create(
+                title="Synthetic task %d" % (counter + 1),
+                message="Synthetic push notification for load testing.",
+                url=url, is_active=True, run_at=now,
+            )
+            counter += 1
+        return counter
+
+
+class Picker(object):
+    """Weighted random choice of dict keys"""
+    
+    def __init__(self, weights):
+        self.items = list(weights)
+        self.cum_weights = list(accumulate( weights[k] for k in self.items ))
+    
+    def pick(self, rnd):
+        return rnd.choices(self.items, cum_weights=self.cum_weights)[0]
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).strip(b'=').decode('utf8')
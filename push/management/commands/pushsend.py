@@ -1,79 +1,45 @@
 # -*- coding: utf-8 -*-
-from pywebpush import WebPusher, webpush, WebPushException
 import urllib3
-from requests import exceptions as requests_ex
 
 import time
 import logging
 import os
+import signal
+import socket
 from multiprocessing import Pool
 import json
 from random import randint
-from datetime import timedelta
+from collections import defaultdict
+from datetime import timedelta, datetime, timezone as dt_timezone
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from django.conf import settings
+from django.db import close_old_connections
 
 from commonstuff.models import PidLock
 
-from push.models import DigestSubscription, TimezoneLayout, Task
+from push.models import DigestSubscription, TimezoneLayout, Task, SendShard, \
+                        RetryPush, TimezoneSubscribers
+from push import stats, payload_cache, save_queue, wakeup
+from push.metrics import RunMetrics
+from push.sender import ENGINES, INVALID_ENDPOINT_EXCEPTIONS, \
+                        TRANSIENT_EXCEPTIONS, httpx, endpoint_origin, \
+                        init_push_worker, close_push_worker, warm_push_worker
 from push.settings import FCM_SERVER_KEY, PUSHSEND_WORKERS, VAPID_PRIVATE_KEY,\
-                          VAPID_ADMIN_EMAIL
-
-
-# must be top level function to be used in Pool
-# receives only 1 param (tuple with all data)
-def send_push_worker(data):
-    (
-        subscr_list,
-        payload,
-        ttl,
-        gcm_key,
-        vapid_key,
-        vapid_email,
-    ) = data
-    
-    responses = []
-    exceptions = []  # can't use logger in a worker
-    for subscr in subscr_list:
-        try:
-            if subscr.is_gcm(): 
-                response = WebPusher( subscr.endpoint_and_keys() ).send(
-                    data=payload if subscr.supports_payload() else None,
-                    ttl=ttl,
-                    timeout=3.0,
-                    gcm_key=gcm_key,
-                    # seems to be the only encoding legacy chrome understands
-                    # for payload encryption
-                    content_encoding="aesgcm"
-                )
-                responses.append( (subscr, response) )
-            else:
-                try:
-                    response = webpush(
-                        subscription_info=subscr.endpoint_and_keys(),
-                        data=payload if subscr.supports_payload() else None,
-                        ttl=ttl,
-                        timeout=3.0,
-                        vapid_private_key=vapid_key,
-                        vapid_claims={"sub": "mailto:"+vapid_email,}
-                    )
-                    responses.append( (subscr, response) )
-                except WebPushException as e:
-                    # WebPushException got response object but we need to count
-                    # error points on subscriptions
-                    responses.append( (subscr, e.response) )
-        except Exception as e:
-            exceptions.append( (subscr, e, time.time(),) )
-    
-    return (responses, exceptions)
+                          VAPID_ADMIN_EMAIL, PUSHSEND_ENGINE, \
+                          PUSHSEND_PREWARM_ORIGINS, PUSHSEND_SHARDED, \
+                          PUSHSEND_SHARD_SIZE, PUSHSEND_SHARD_LEASE, \
+                          PUSHSEND_RESULT_CHUNK, PUSHSEND_ASYNC_CONCURRENCY, \
+                          PUSHSEND_DEFERRED_MAX_WAIT, PUSHSEND_RETRY_BASE, \
+                          PUSHSEND_RETRY_ATTEMPTS, PUSHSEND_METRICS_FILE, \
+                          PUSHSEND_DAEMON_MAX_SLEEP, SAVE_QUEUE
 
 
 class Command(BaseCommand):
     """Command that sends push notifications"""
     
-    help = 'Pushes notification to web-subscribers (cron use only)'
+    help = 'Pushes notification to web-subscribers (from cron, or keeps running with --daemon)'
     
     DB_LIMIT = 7000  # get subscribers objs from DB by X at a time
     # Notification time to live (int seconds).
@@ -85,10 +51,23 @@ class Command(BaseCommand):
     pid_lock = None
     logger = None
     db_logger = None
+    engine = None
+    pool = None
+    workers_started = False
+    payloads = None
+    node = None
+    deferred = None
+    metrics = None
+    stopping = False
     
     def __init__(self, *args, **kwargs):
         # protection against several copies of pushsend running at the same time
-        self.pid_lock = PidLock(process=__file__)
+        # (on the same host, if several hosts share the work in sharded mode)
+        self.node = "%s:%d" % (socket.gethostname(), os.getpid())
+        if PUSHSEND_SHARDED:
+            self.pid_lock = PidLock(process="%s@%s" % (__file__, socket.gethostname()))
+        else:
+            self.pid_lock = PidLock(process=__file__)
         self.pid_lock.save_or_die()
         
         # everything (except destructor method) after save_or_die may not run
@@ -126,113 +105,435 @@ class Command(BaseCommand):
         if self.pid_lock and self.pid_lock.pk:
             self.pid_lock.delete()
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', choices=sorted(ENGINES), default=PUSHSEND_ENGINE,
+            help='How to send pushes: sync requests or asyncio over HTTP/2.'
+        )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running and send every timezone layout right at it\'s time '
+                 '(SIGTERM or SIGINT stops it after the current pass).'
+        )
+    
     def handle(self, *args, **options):
+        if options['engine'] not in ENGINES:
+            raise CommandError("Unknown pushsend engine: %s" % options['engine'])
+        if options['engine'] == 'async' and httpx is None:
+            raise CommandError("Async pushsend engine needs httpx[http2] installed.")
+        self.engine = options['engine']
+        
         urllib3.disable_warnings()
+        if options['daemon']:
+            self.daemon()
+            return
+        try:
+            self.run_once()
+        finally:
+            self.stop_workers()
+    
+    def daemon(self):
+        """
+        Runs send passes one after another, sleeping until the next timezone
+        layout or retry is due (or until a push task is saved). Sender
+        processes and their connections stay alive between the passes.
+        """
+        def stop(signum, frame):
+            self.logger.info("pushsend daemon got signal %d, stopping.", signum)
+            self.stopping = True
+        old_handlers = {
+            signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT,)
+        }
+        
+        try:
+            while not self.stopping:
+                # task saved during the pass should wake us up right after it
+                token = wakeup.token()
+                close_old_connections()
+                try:
+                    # paused push services get deferred pushes from the
+                    # retry queue, instead of the daemon waiting for them
+                    self.run_once(deferred_max_wait=0)
+                    wake_at = self.next_wake_at()
+                except Exception:
+                    # e.g. database restart, let's try again a bit later
+                    self.logger.exception("pushsend daemon pass failed.")
+                    wake_at = time.time() + PUSHSEND_DAEMON_MAX_SLEEP
+                close_old_connections()
+                self.logger.debug("pushsend daemon sleeps until %s.",
+                                  time.asctime(time.localtime(wake_at)))
+                wakeup.wait(wake_at, token, stop=lambda: self.stopping)
+        finally:
+            self.stop_workers()
+            for signum, handler in old_handlers.items():
+                signal.signal(signum, handler)
+    
+    def next_wake_at(self):
+        """Unix timestamp of the next send pass for daemon mode"""
+        wake_at = time.time() + PUSHSEND_DAEMON_MAX_SLEEP
+        for moment in (TimezoneLayout.next_run_at(), RetryPush.next_retry_at()):
+            if moment is not None:
+                wake_at = min(wake_at, moment.timestamp())
+        return wake_at
+    
+    def run_once(self, deferred_max_wait=None):
+        """
+        One send pass: everything that is due now. Deferred pushes are waited
+        for deferred_max_wait seconds (PUSHSEND_DEFERRED_MAX_WAIT by default).
+        """
+        # tasks could be edited since the last pass of daemon
+        self.payloads = {}
+        self.deferred = []
+        self.metrics = RunMetrics()
+        
         self.clean_push_db()
+        # views and clicks buffered in cache by views
+        stats.flush_recent()
+        # new subscribers should get this push too
+        if SAVE_QUEUE:
+            save_queue.flush()
         
-        tz_layouts = list(TimezoneLayout.undone_objects.all())
-        for tz_layout in tz_layouts:
-            task = tz_layout.task
+        try:
+            self.send_retries()
+            # nothing to send for most of the timezones
+            TimezoneLayout.finish_empty()
+            if PUSHSEND_SHARDED:
+                self.send_shards()
+            else:
+                self.send_tz_layouts()
+            self.send_deferred(deferred_max_wait)
+            self.send_retries()
+        finally:
+            self.write_metrics()
+    
+    def write_metrics(self):
+        self.metrics.finish()
+        # idle run (every daemon pass without due layouts) keeps the last
+        # real one in the file
+        if not self.metrics.total_pushes():
+            return
+        self.logger.info(
+            "%d pushes at %.1f per second, phases: %s.",
+            self.metrics.total_pushes(), self.metrics.pushes_per_second(),
+            ", ".join( "%s %.3fs" % p for p in sorted(self.metrics.phases.items()) )
+        )
+        if not PUSHSEND_METRICS_FILE:
+            return
+        try:
+            self.metrics.write(PUSHSEND_METRICS_FILE)
+        except OSError as e:
+            self.logger.error("Can't write pushsend metrics: %s", e)
+    
+    def send_tz_layouts(self):
+        # Dozens of timezones share the same UTC instant, so layouts of the
+        # same task with the same run_at are sent in one pass.
+        groups = defaultdict(list)
+        for tz_layout in TimezoneLayout.undone_objects.select_related('task'):
+            groups[(tz_layout.task_id, tz_layout.run_at)].append(tz_layout)
+        
+        for tz_layouts in groups.values():
+            task = tz_layouts[0].task
+            layouts_qs = TimezoneLayout.objects.filter(pk__in=[ l.pk for l in tz_layouts ])
             
-            tz_layout.started_at = timezone.now()
-            tz_layout.save(update_fields=['started_at'])
-            if not task.started_at:
-                task.started_at = timezone.now()
-                task.save(update_fields=['started_at'])
+            started_at = timezone.now()
+            layouts_qs.update(started_at=started_at)
+            payload_cache.invalidate()
+            # every group has it's own task instance, only the first one
+            # of them really starts the task
+            Task.objects.filter(pk=task.pk, started_at__isnull=True) \
+                        .update(started_at=started_at)
             
             # subscribers
-            # can't filter by is_active=True, because after sending each pack
-            # we disable erroneous subscriptions and this shifts the slice 
-            # if only active objects selected.
-            # TODO: This definitely needs optimisation some day.
-            qs = DigestSubscription.objects \
-                    .filter(timezone=tz_layout.timezone) \
-                    .order_by('id')
-            
-            # send
-            max_i = qs.count()
             # no more than DB_LIMIT objects at a time to save RAM
-            for i in range(0, max_i, self.DB_LIMIT):
-                subscriptions = qs[i:(i+self.DB_LIMIT)]
-                active_subscriptions = [ s for s in subscriptions if s.is_active ]
-                subscriptions = None
-                if not active_subscriptions:
-                    continue  # next pack if no active subscribers in this one
-                
-                max_workers = min(PUSHSEND_WORKERS, len(active_subscriptions))
-                pool_data = []
-                for i in range(max_workers):
-                    pool_data.append(
-                        (
-                            # different for each worker
-                            active_subscriptions[i::max_workers],
-                            # common
-                            json.dumps( task.get_payload() ),
-                            self.TTL,
-                            FCM_SERVER_KEY,
-                            VAPID_PRIVATE_KEY,
-                            VAPID_ADMIN_EMAIL,
-                        )
-                    )
-                active_subscriptions = None
-
-                if max_workers == 1:
-                    responses, exceptions = send_push_worker(pool_data[0])
+            timezones = [ l.timezone for l in tz_layouts ]
+            batches = DigestSubscription.active_batches(
+                self.DB_LIMIT, timezone__in=timezones
+            )
+            with self.metrics.layout(task.pk, timezones):
+                batches = self.metrics.timed('db_fetch', batches)
+                for i, active_subscriptions in enumerate(batches):
+                    if i == 0:
+                        self.prewarm()
+                    self.send_batch(task, active_subscriptions)
+            
+            layouts_qs.update(done_at=timezone.now())
+            if task.all_timezones_done():
+                Task.objects.filter(pk=task.pk, done_at__isnull=True) \
+                            .update(done_at=timezone.now())
+    
+    def send_shards(self):
+        """
+        Sharded mode: several pushsend processes (on different hosts) lease
+        subscriber id ranges of timezone layouts from DB and send them.
+        """
+        for tz_layout in TimezoneLayout.due_objects.filter(started_at__isnull=True):
+            SendShard.start_layout(tz_layout, PUSHSEND_SHARD_SIZE)
+        
+        while True:
+            shard = SendShard.lease(self.node, PUSHSEND_SHARD_LEASE)
+            if shard is None:
+                break
+            self.send_shard(shard)
+        
+        # node died after its last shard was done, but before the layout was
+        # marked as done
+        unfinished_shards = SendShard.objects.filter(done_at__isnull=True)
+        tz_layouts = TimezoneLayout.due_objects \
+            .filter(started_at__isnull=False, sendshard__isnull=False) \
+            .exclude(pk__in=unfinished_shards.values('tz_layout_id')) \
+            .distinct()
+        for tz_layout in tz_layouts:
+            tz_layout.finish()
+    
+    def send_shard(self, shard):
+        tz_layout = shard.tz_layout
+        self.logger.info("%s leased %s.", self.node, shard)
+        # continue from where the previous owner of this shard stopped
+        batches = DigestSubscription.active_batches(
+            self.DB_LIMIT,
+            after_id=max(shard.last_id, shard.id_from - 1),
+            timezone=tz_layout.timezone,
+            id__lt=shard.id_to
+        )
+        with self.metrics.layout(tz_layout.task_id, [tz_layout.timezone]):
+            batches = self.metrics.timed('db_fetch', batches)
+            for i, active_subscriptions in enumerate(batches):
+                if i == 0:
+                    self.prewarm()
+                last_id = active_subscriptions[-1].id
+                self.send_batch(tz_layout.task, active_subscriptions)
+                if not shard.heartbeat(PUSHSEND_SHARD_LEASE, last_id=last_id):
+                    self.logger.warning("%s lost lease of %s.", self.node, shard)
+                    return
+        shard.finish()
+    
+    def send_batch(self, task, active_subscriptions, retries=None):
+        """
+        Sends task to subscriptions and does error accounting for every chunk
+        of results as soon as it is ready, while workers continue sending.
+        
+        Transient failures go to retry queue (or back to it, if the batch
+        is made of retries).
+        """
+        failed_ids = set()
+        if active_subscriptions:
+            self.metrics.batches += 1
+            results = self.metrics.timed(
+                'pool', self.send(active_subscriptions, self.task_payload(task))
+            )
+            for responses, exceptions, deferred in results:
+                with self.metrics.timer('accounting'):
+                    failed_ids |= self.account_results(responses, exceptions)
+                self.metrics.deferred(len(deferred))
+                for subscr, retry_at in deferred:
+                    if retries is None:
+                        self.deferred.append( (task, subscr, retry_at,) )
+                    else:
+                        # it is in retry queue already, let it stay there
+                        # (the last retries of a run have no deferred pass)
+                        failed_ids.add(subscr.pk)
+        
+        if retries is None:
+            RetryPush.schedule(task, failed_ids, self.TTL, PUSHSEND_RETRY_BASE)
+        else:
+            RetryPush.reschedule(retries, failed_ids, PUSHSEND_RETRY_BASE,
+                                 PUSHSEND_RETRY_ATTEMPTS)
+    
+    def send_deferred(self, max_wait=None):
+        """
+        Sends to subscriptions that workers deferred because their push
+        service asked us to come back later (Retry-After or circuit breaker),
+        waiting for it no longer than max_wait seconds in total
+        (PUSHSEND_DEFERRED_MAX_WAIT by default), the rest goes to retry queue.
+        """
+        if max_wait is None:
+            max_wait = PUSHSEND_DEFERRED_MAX_WAIT
+        deadline = time.time() + max_wait
+        while self.deferred:
+            retry_at = min( d[2] for d in self.deferred )
+            if retry_at > deadline:
+                break
+            time.sleep(max(0, retry_at - time.time()))
+            
+            due = defaultdict(list)
+            deferred, self.deferred = self.deferred, []
+            for task, subscr, retry_at in deferred:
+                if retry_at <= time.time():
+                    due[task].append(subscr)
                 else:
-                    pool = Pool(processes=max_workers)
-                    multi_result = pool.map(send_push_worker, pool_data)
-                    # https://stackoverflow.com/questions/20914828/python-multiprocessing-pool-join-not-waiting-to-go-on
-                    # https://stackoverflow.com/questions/25391025/what-exactly-is-python-multiprocessing-modules-join-method-doing
-                    pool.close()
-                    pool.join()
-                    responses = []
-                    exceptions = []
-                    # flattern result list
-                    for result in multi_result:
-                        responses += result[0]
-                        exceptions += result[1]
-                    multi_result = None
-                pool_data = None
+                    self.deferred.append( (task, subscr, retry_at,) )
+            for task, subscr_list in due.items():
+                self.send_batch(task, subscr_list)
+        
+        if self.deferred:
+            self.logger.warning(
+                "%d deferred pushes go to retry queue, push services are paused.",
+                len(self.deferred)
+            )
+            by_task = defaultdict(list)
+            for task, subscr, retry_at in self.deferred:
+                by_task[task].append( (subscr.pk, retry_at,) )
+            for task, deferred in by_task.items():
+                retry_at = max( d[1] for d in deferred )
+                RetryPush.schedule(
+                    task, [ d[0] for d in deferred ], self.TTL, PUSHSEND_RETRY_BASE,
+                    retry_at=datetime.fromtimestamp(retry_at, tz=dt_timezone.utc)
+                )
+            self.deferred = []
+    
+    def send_retries(self):
+        """Sends due pushes from retry queue (transient failures of earlier sends)"""
+        retries_batches = RetryPush.claim_due(
+            self.node, self.DB_LIMIT, PUSHSEND_SHARD_LEASE
+        )
+        for retries in retries_batches:
+            by_task = defaultdict(list)
+            for retry in retries:
+                by_task[retry.task].append(retry)
+            for task, task_retries in by_task.items():
+                if task.is_active:
+                    active_subscriptions = [ r.subscription for r in task_retries \
+                                             if r.subscription.is_active ]
+                else:
+                    active_subscriptions = []
+                self.send_batch(task, active_subscriptions, retries=task_retries)
+    
+    def account_results(self, responses, exceptions):
+        """
+        Subscription error accounting for send results.
+        Returns set of subscription ids that failed for a transient reason.
+        """
+        failed_ids = set()
+        # can't use logger in workers, so log their exceptions here
+        invalid_ids = []
+        for subscr, e, timestamp in exceptions:
+            self.metrics.exception()
+            self.logger.error(
+                "%s, %s: %s, %s" % (
+                    "Exception from push worker", 
+                    time.asctime(time.localtime(timestamp)), 
+                    type(e), e
+                )
+            )
+            # endpoint is not url
+            if isinstance(e, INVALID_ENDPOINT_EXCEPTIONS):
+                invalid_ids.append(subscr.pk)
+            elif isinstance(e, TRANSIENT_EXCEPTIONS):
+                failed_ids.add(subscr.pk)
+        
+        # changing DB from workers is also a problem
+        error_points = defaultdict(list)
+        for subscr, response in responses:
+            self.metrics.response(endpoint_origin(subscr.endpoint),
+                                  response.status_code, response.elapsed)
+            try:
+                self.logger.debug("Response for subscr %d" % subscr.pk)
+                self.logger.debug(response)
+                self.logger.debug(response.text)
                 
-                # can't use logger in workers, so log their exceptions here
-                for subscr, e, timestamp in exceptions:
-                    self.logger.error(
-                        "%s, %s: %s, %s" % (
-                            "Exception from push worker", 
-                            time.asctime(time.localtime(timestamp)), 
-                            type(e), e
-                        )
+                points, new_endpoint = subscr.push_service_response_error_points(
+                    response.status_code,
+                    response.text
+                )
+                if points:
+                    error_points[points].append(subscr.pk)
+                if new_endpoint is not None:
+                    subscr.change_endpoint(new_endpoint)
+                if subscr.push_service_response_is_transient(response.status_code,
+                                                             response.text):
+                    failed_ids.add(subscr.pk)
+            except Exception as e:
+                self.logger.exception(
+                    "%s, %s: %s" % (
+                        "Exception while subscription error accounting", 
+                        time.asctime(time.localtime(time.time())),
+                        e
                     )
-                    # endpoint is not url
-                    if isinstance(e, requests_ex.InvalidURL) \
-                    or isinstance(e, requests_ex.URLRequired): 
-                        subscr.deactivate().save()
-                
-                # changing DB from workers is also a problem
-                for subscr, response in responses:
-                    try:
-                        self.logger.debug("Response for subscr %d" % subscr.pk)
-                        self.logger.debug(response)
-                        self.logger.debug(response.text)
-                        
-                        subscr.push_service_response_to_errors(
-                            response.status_code,
-                            response.text
-                        )
-                    except Exception as e:
-                        self.logger.exception(
-                            "%s, %s: %s" % (
-                                "Exception while subscription error accounting", 
-                                time.asctime(time.localtime(time.time())),
-                                e
-                            )
-                        )
-            
-            tz_layout.done_at = timezone.now()
-            tz_layout.save(update_fields=['done_at'])
-            if task.all_timezones_done():
-                task.done_at = timezone.now()
-                task.save(update_fields=['done_at'])
+                )
+        # whole batch at once, by a few UPDATE queries
+        DigestSubscription.bulk_deactivate(invalid_ids)
+        DigestSubscription.bulk_errors_accounting(error_points)
+        return failed_ids
+    
+    def task_payload(self, task):
+        """Serialized task payload, made only once per run for each task"""
+        if task.pk not in self.payloads:
+            self.payloads[task.pk] = json.dumps( task.get_payload() )
+        return self.payloads[task.pk]
+    
+    def start_workers(self):
+        """
+        Starts sender processes once per run (and only if there is something
+        to send), so they keep signed VAPID headers and open connections
+        between batches and timezone layouts.
+        """
+        if self.workers_started:
+            return
+        worker_args = (self.engine, self.TTL, FCM_SERVER_KEY,
+                       VAPID_PRIVATE_KEY, VAPID_ADMIN_EMAIL,)
+        if PUSHSEND_WORKERS > 1:
+            self.pool = Pool(processes=PUSHSEND_WORKERS,
+                             initializer=init_push_worker, initargs=worker_args)
+        else:
+            init_push_worker(*worker_args)  # no multiprocessing, send from here
+        self.workers_started = True
+    
+    def stop_workers(self):
+        if self.pool is not None:
+            # https://stackoverflow.com/questions/20914828/python-multiprocessing-pool-join-not-waiting-to-go-on
+            # https://stackoverflow.com/questions/25391025/what-exactly-is-python-multiprocessing-modules-join-method-doing
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        elif self.workers_started:
+            close_push_worker()
+        self.workers_started = False
+    
+    def prewarm(self, origins=None):
+        """
+        Connect workers to known push services (PUSHSEND_PREWARM_ORIGINS by
+        default) before timezone layout starts.
+        Best effort for the pool: every sender process most likely takes one
+        warm up job, because each of them is busy with network for a while.
+        """
+        if origins is None:
+            origins = PUSHSEND_PREWARM_ORIGINS
+        if not origins:
+            return
+        self.start_workers()
+        if self.pool is None:
+            warm_push_worker(origins)
+        else:
+            self.pool.map(warm_push_worker,
+                          [origins] * PUSHSEND_WORKERS,
+                          chunksize=1)
+    
+    def send(self, subscr_list, payload):
+        """
+        Sends payload to subscriptions using worker processes.
+        
+        Generator of (responses, exceptions) tuples of lists for small chunks
+        of subscriptions, in order they are done. So results never pile up
+        in memory for the whole batch.
+        """
+        self.start_workers()
+        send_worker = ENGINES[self.engine]
+        if self.engine == 'async':
+            # async worker keeps in flight no more requests than it's chunk
+            chunk_size = PUSHSEND_ASYNC_CONCURRENCY
+        else:
+            chunk_size = PUSHSEND_RESULT_CHUNK
+        chunks = (
+            (subscr_list[i:(i+chunk_size)], payload)
+            for i in range(0, len(subscr_list), chunk_size)
+        )
+        if self.pool is None:
+            for chunk in chunks:
+                yield send_worker(chunk)
+        else:
+            # pool queue hands chunks out to sender processes
+            for result in self.pool.imap_unordered(send_worker, chunks):
+                yield result
     
     def clean_push_db(self):
         """
@@ -253,3 +554,6 @@ class Command(BaseCommand):
             is_active=False,
             deactivated_at__lt=( timezone.now() - timedelta(days=365) )
         ).delete()
+        
+        # fix active subscribers counters if something went around them
+        TimezoneSubscribers.recount()
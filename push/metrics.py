@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import json
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+
+
+class RunMetrics(object):
+    """
+    Where a pushsend run spends it's time and what push services answer.
+    
+    Phases are: db_fetch (reading subscribers), pool (waiting for sender
+    processes, or sending itself without the pool) and accounting (error
+    accounting of send results). Pushes are counted by response status code,
+    'exception' (no response) and 'deferred' (push service asked to wait).
+    """
+    
+    PREFIX = 'infopush_pushsend'
+    # seconds, push service response time histogram
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,)
+    
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.phases = defaultdict(float)
+        self.pushes = Counter()
+        self.batches = 0
+        self.layouts = []
+        # origin: [count for every bucket (not cumulative), sum, count]
+        self.latency = {}
+    
+    @contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.time() - start
+    
+    def timed(self, phase, iterable):
+        """Iterates over iterable counting the time of waiting for it's items"""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.phases[phase] += time.time() - start
+            yield item
+    
+    @contextmanager
+    def layout(self, task_id, timezones):
+        """Counts time and pushes of one send pass (layout or shard)"""
+        start = time.time()
+        pushes = self.total_pushes()
+        try:
+            yield
+        finally:
+            self.layouts.append({
+                'task': task_id,
+                'timezones': timezones,
+                'seconds': round(time.time() - start, 3),
+                'pushes': self.total_pushes() - pushes,
+            })
+    
+    def response(self, origin, status_code, elapsed=None):
+        self.pushes[str(status_code)] += 1
+        if elapsed is None:
+            return
+        try:
+            histogram = self.latency[origin]
+        except KeyError:
+            histogram = self.latency[origin] = [0] * len(self.LATENCY_BUCKETS) + [0.0, 0]
+        for i, le in enumerate(self.LATENCY_BUCKETS):
+            if elapsed <= le:
+                histogram[i] += 1
+                break
+        histogram[-2] += elapsed
+        histogram[-1] += 1
+    
+    def exception(self):
+        self.pushes['exception'] += 1
+    
+    def deferred(self, quantity=1):
+        if quantity:
+            self.pushes['deferred'] += quantity
+    
+    def total_pushes(self):
+        return sum(self.pushes.values())
+    
+    def finish(self):
+        self.finished_at = time.time()
+    
+    def seconds(self):
+        return (self.finished_at or time.time()) - self.started_at
+    
+    def pushes_per_second(self):
+        seconds = self.seconds()
+        return self.total_pushes() / seconds if seconds else 0.0
+    
+    def report(self):
+        """JSON serializable run report"""
+        return {
+            'started_at': self.started_at,
+            'seconds': round(self.seconds(), 3),
+            'phases': { k: round(v, 3) for k, v in self.phases.items() },
+            'pushes': dict(self.pushes),
+            'pushes_per_second': round(self.pushes_per_second(), 3),
+            'batches': self.batches,
+            'layouts': self.layouts,
+            'latency': {
+                origin: {
+                    'buckets': dict(zip([ str(le) for le in self.LATENCY_BUCKETS ],
+                                        histogram[:-2])),
+                    'sum': round(histogram[-2], 3),
+                    'count': histogram[-1],
+                } for origin, histogram in self.latency.items()
+            },
+        }
+    
+    def prometheus(self):
+        """Prometheus text exposition format (for node exporter textfile collector)"""
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            name = "%s_%s" % (self.PREFIX, name)
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                if labels:
+                    labels = "{%s}" % ",".join(
+                        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                        for k, v in labels
+                    )
+                else:
+                    labels = ""
+                lines.append("%s%s%s %s" % (name, suffix, labels, repr(float(value))))
+        
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run started.',
+               [('', None, self.started_at)])
+        metric('run_seconds', 'gauge', 'Duration of the last run.',
+               [('', None, self.seconds())])
+        metric('phase_seconds', 'gauge', 'Time of the last run spent in phases.',
+               [ ('', [('phase', k)], v) for k, v in sorted(self.phases.items()) ])
+        metric('pushes', 'gauge', 'Pushes of the last run by result.',
+               [ ('', [('result', k)], v) for k, v in sorted(self.pushes.items()) ])
+        metric('pushes_per_second', 'gauge', 'Average send rate of the last run.',
+               [('', None, self.pushes_per_second())])
+        metric('batches', 'gauge', 'Subscriber batches of the last run.',
+               [('', None, self.batches)])
+        metric('layouts', 'gauge', 'Send passes (timezone layouts or shards) of the last run.',
+               [('', None, len(self.layouts))])
+        # shards of the same layout have the same task and timezones
+        layout_labels = [
+            [('pass', i), ('task', l['task']), ('timezones', ",".join(sorted(l['timezones'])))]
+            for i, l in enumerate(self.layouts)
+        ]
+        metric('layout_seconds', 'gauge', 'Duration of every send pass of the last run.',
+               [ ('', labels, l['seconds']) for labels, l in zip(layout_labels, self.layouts) ])
+        metric('layout_pushes', 'gauge', 'Pushes of every send pass of the last run.',
+               [ ('', labels, l['pushes']) for labels, l in zip(layout_labels, self.layouts) ])
+        samples = []
+        for origin, histogram in sorted(self.latency.items()):
+            cumulative = 0
+            for le, count in zip(self.LATENCY_BUCKETS, histogram[:-2]):
+                cumulative += count
+                samples.append( ('_bucket', [('origin', origin), ('le', le)], cumulative) )
+            samples.append( ('_bucket', [('origin', origin), ('le', '+Inf')], histogram[-1]) )
+            samples.append( ('_sum', [('origin', origin)], histogram[-2]) )
+            samples.append( ('_count', [('origin', origin)], histogram[-1]) )
+        metric('push_latency_seconds', 'histogram',
+               'Push service response time of the last run.', samples)
+        
+        return "\n".join(lines) + "\n"
+    
+    def write(self, path):
+        """
+        Prometheus textfile (path ends with .prom) or JSON report.
+        Replaces the file at once, so it is never read half written.
+        """
+        if path.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.report(), indent=2)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0004_auto_20221006_1553'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('id_from', models.PositiveIntegerField(editable=False)),
+                ('id_to', models.PositiveIntegerField(editable=False)),
+                ('last_id', models.PositiveIntegerField(default=0, editable=False)),
+                ('leased_by', models.CharField(blank=True, default='', editable=False, max_length=255)),
+                ('leased_until', models.DateTimeField(blank=True, db_index=True, editable=False, null=True)),
+                ('done_at', models.DateTimeField(blank=True, db_index=True, editable=False, null=True)),
+                ('tz_layout', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='push.timezonelayout')),
+            ],
+            options={
+                'unique_together': {('tz_layout', 'id_from')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0005_sendshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetryPush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False)),
+                ('retry_at', models.DateTimeField(db_index=True, editable=False)),
+                ('deadline', models.DateTimeField(db_index=True, editable=False)),
+                ('claimed_by', models.CharField(blank=True, default='', editable=False, max_length=255)),
+                ('subscription', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='push.digestsubscription')),
+                ('task', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='push.task')),
+            ],
+            options={
+                'unique_together': {('subscription', 'task')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+def count_subscribers(apps, schema_editor):
+    DigestSubscription = apps.get_model('push', 'DigestSubscription')
+    TimezoneSubscribers = apps.get_model('push', 'TimezoneSubscribers')
+    counts = DigestSubscription.objects.filter(is_active=True) \
+                                       .order_by() \
+                                       .values_list('timezone') \
+                                       .annotate(models.Count('id'))
+    TimezoneSubscribers.objects.bulk_create([
+        TimezoneSubscribers(timezone=tz, active=active) for tz, active in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0006_retrypush'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimezoneSubscribers',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timezone', models.CharField(editable=False, max_length=48, unique=True, verbose_name='timezone')),
+                ('active', models.IntegerField(default=0, editable=False, verbose_name='active subscribers')),
+            ],
+            options={
+                'verbose_name': 'timezone subscribers',
+                'verbose_name_plural': 'timezone subscribers',
+            },
+        ),
+        migrations.RunPython(count_subscribers, migrations.RunPython.noop),
+    ]
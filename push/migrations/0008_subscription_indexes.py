@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0007_timezonesubscribers'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='digestsubscription',
+            index=models.Index(fields=['is_active', 'timezone', 'id'], name='push_subscr_active_tz_id'),
+        ),
+        migrations.AddIndex(
+            model_name='digestsubscription',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['timezone', 'id'], name='push_subscr_tz_id_if_active'),
+        ),
+        migrations.AddIndex(
+            model_name='digestsubscription',
+            index=models.Index(fields=['is_active', 'deactivated_at'], name='push_subscr_active_deact'),
+        ),
+        migrations.AddIndex(
+            model_name='digestsubscription',
+            index=models.Index(condition=models.Q(('is_active', False)), fields=['deactivated_at'], name='push_subscr_deact_if_inactive'),
+        ),
+    ]
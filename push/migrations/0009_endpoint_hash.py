@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import hashlib
+
+from django.db import migrations, models, transaction
+
+
+# Big tables: every batch is it's own transaction (migration is not atomic),
+# so the table is not locked for the whole backfill. Only unique index
+# creation at the end holds the lock.
+def fill_endpoint_hash(apps, schema_editor):
+    DigestSubscription = apps.get_model('push', 'DigestSubscription')
+    last_id = 0
+    while True:
+        batch = list(
+            DigestSubscription.objects.filter(id__gt=last_id) \
+                                      .only('id', 'endpoint') \
+                                      .order_by('id')[:1000]
+        )
+        if not batch:
+            return
+        for subscr in batch:
+            # same as BaseSubscription.hash_endpoint()
+            subscr.endpoint_hash = hashlib.blake2b(
+                subscr.endpoint.encode('utf8'), digest_size=16
+            ).hexdigest()
+        with transaction.atomic():
+            DigestSubscription.objects.bulk_update(batch, ['endpoint_hash'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('push', '0008_subscription_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='digestsubscription',
+            name='endpoint_hash',
+            field=models.CharField(editable=False, max_length=32, null=True, verbose_name='endpoint hash'),
+        ),
+        migrations.RunPython(fill_endpoint_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='digestsubscription',
+            name='endpoint_hash',
+            field=models.CharField(editable=False, max_length=32, unique=True, verbose_name='endpoint hash'),
+        ),
+        migrations.AlterField(
+            model_name='digestsubscription',
+            name='endpoint',
+            field=models.CharField(editable=False, max_length=512, verbose_name='endpoint'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations
+
+
+class PostgreSQLRunSQL(migrations.RunSQL):
+    """RunSQL that does nothing on other databases"""
+    
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super(PostgreSQLRunSQL, self).database_forwards(app_label, schema_editor, from_state, to_state)
+    
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super(PostgreSQLRunSQL, self).database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('push', '0010_subscription_indexes_cleanup'),
+    ]
+
+    operations = [
+        # unique varchar gets an extra varchar_pattern_ops index on PostgreSQL
+        # for LIKE lookups, hash is only looked up by equality
+        PostgreSQLRunSQL(
+            'DROP INDEX IF EXISTS "push_digestsubscription_endpoint_hash_d724fbb7_like"',
+            'CREATE INDEX "push_digestsubscription_endpoint_hash_d724fbb7_like" '
+            'ON "push_digestsubscription" ("endpoint_hash" varchar_pattern_ops)',
+        ),
+    ]
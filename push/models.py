@@ -4,20 +4,33 @@ import pytz
 from urllib.parse import urlparse, urlunparse, parse_qs
 from urllib.parse import urlencode
 import json
+import hashlib
 from datetime import timedelta
+from collections import defaultdict, Counter
+from functools import lru_cache
 
 from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Case, When, Value
 from django.utils import timezone
 from django.utils.html import mark_safe
 from django.urls import reverse
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
+from django.core import signing
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
 from commonstuff.models_base import ModelWith2Images
 
 from .settings import DEFAULT_ICON_URL, ERROR_THRESHOLD, GCM_URL
+from . import payload_cache, wakeup
+
+
+# salt for signed redirect targets of notification clicks
+CLICK_SALT = 'push.show_notification'
+# seconds, older signed links go through the database (and deactivated
+# task is not shown anymore), like they did before
+CLICK_MAX_AGE = 7 * 24 * 60 * 60
 
 
 # http://stackoverflow.com/questions/27072222/django-1-7-1-makemigrations-fails-when-using-lambda-as-default-for-attribute
@@ -25,36 +38,250 @@ def _timezone_now():
     return timezone.now()
 
 
+@lru_cache(maxsize=32)
+def _timezone_offsets(moment):
+    """UTC offsets of every pytz timezone at the moment"""
+    return {
+        tz_str: moment.astimezone(pytz.timezone(tz_str)).utcoffset()
+        for tz_str in pytz.all_timezones_set
+    }
+
+
 class BaseSubscription(models.Model):
     """Base class for push subscriptions"""
     
-    endpoint = models.CharField(_('endpoint'), max_length=512, unique=True, editable=False)
+    endpoint = models.CharField(_('endpoint'), max_length=512, editable=False)
+    # short fixed width unique key for endpoint lookups (see hash_endpoint)
+    endpoint_hash = models.CharField(_('endpoint hash'), max_length=32, unique=True, editable=False)
     key = models.CharField(_('key'), max_length=255, blank=True, default='', editable=False)
     auth_secret = models.CharField(_('auth secret'), max_length=255, blank=True, default='', editable=False)
-    is_active = models.BooleanField(_('is active'), default=True, db_index=True)
+    is_active = models.BooleanField(_('is active'), default=True)
     errors = models.PositiveIntegerField(_('send errors'), default=0, editable=False)
     ua = models.CharField(_('useragent'), max_length=255, editable=False)
     timezone = models.CharField(
         _('timezone'), max_length=48,
-        choices=((x,x) for x in sorted(pytz.all_timezones_set)),
-        db_index=True
+        choices=((x,x) for x in sorted(pytz.all_timezones_set))
     )
     created_at = models.DateTimeField(_('created'), default=_timezone_now, editable=False)
     activated_at = models.DateTimeField(_('activated'), blank=True, null=True, editable=False)
     deactivated_at = models.DateTimeField(_('deactivated'), blank=True, null=True, editable=False)
     
+    # max ids in one bulk UPDATE query
+    BULK_CHUNK = 1000
+    
+    # (is_active, timezone) as it is in the db, for active subscribers counters
+    _counted = (False, None)
+    
     class Meta:
         abstract = True
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super(BaseSubscription, cls).from_db(db, field_names, values)
+        obj._counted = (obj.__dict__.get('is_active'), obj.__dict__.get('timezone'))
+        return obj
+    
     def save(self, *args, **kwargs):
         if self.is_active and self.activated_at is None:
             self.activated_at = timezone.now()
-        return super(BaseSubscription, self).save(*args, **kwargs)
+        self.endpoint_hash = self.hash_endpoint(self.endpoint)
+        ret = super(BaseSubscription, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'is_active', 'timezone'} & set(update_fields):
+            self.__count_active()
+        return ret
+    
+    def delete(self, *args, **kwargs):
+        ret = super(BaseSubscription, self).delete(*args, **kwargs)
+        self.__count_active(deleted=True)
+        return ret
+    
+    def __count_active(self, deleted=False):
+        was_active, old_timezone = self._counted
+        if was_active is None:
+            return  # field was deferred, we don't know what has changed
+        is_active = self.is_active and not deleted
+        self._counted = (is_active, self.timezone)
+        self._count_active_change(was_active, old_timezone, is_active, self.timezone)
+    
+    @classmethod
+    def _count_active_change(cls, was_active, old_timezone, is_active, new_timezone):
+        deltas = Counter()
+        if was_active:
+            deltas[old_timezone] -= 1
+        if is_active:
+            deltas[new_timezone] += 1
+        deltas = { tz: delta for tz, delta in deltas.items() if delta }
+        if deltas:
+            cls.count_active_by_timezone(deltas)
+    
+    @classmethod
+    def count_active_by_timezone(cls, deltas):
+        """
+        Keep active subscribers counters by timezone up to date.
+        Receives a dict {timezone: change of active subscribers count}.
+        """
+        pass
+    
+    @staticmethod
+    def hash_endpoint(endpoint):
+        """Hex of 16 bytes BLAKE2 digest of endpoint (always 32 chars)"""
+        return hashlib.blake2b(endpoint.encode('utf8'), digest_size=16).hexdigest()
+    
+    @classmethod
+    def by_endpoint(cls, endpoint):
+        """Queryset of subscription with the endpoint (uses endpoint hash index)"""
+        if not endpoint:
+            return cls.objects.none()
+        return cls.objects.filter(endpoint_hash=cls.hash_endpoint(endpoint))
+    
+    @classmethod
+    def upsert(cls, endpoint, **fields):
+        """
+        Saves (re)subscription info from browser with as few queries as
+        possible: only one SELECT if nothing has changed, INSERT for a new
+        subscription, UPDATE of changed columns otherwise.
+        Returns subscription id.
+        """
+        while True:
+            try:
+                row = cls.by_endpoint(endpoint) \
+                                 .values('id', 'is_active', 'errors', 'timezone',
+                                         *[ f for f in fields if f != 'timezone' ]) \
+                                 .get()
+            except cls.DoesNotExist:
+                subscr = cls(endpoint=endpoint, **fields)
+                try:
+                    with transaction.atomic():
+                        subscr.save()
+                    return subscr.id
+                except IntegrityError:
+                    continue  # somebody has just saved the same endpoint
+            
+            changes = cls._upsert_changes(row, fields)
+            if not changes:
+                return row['id']
+            
+            # active subscribers counters depend on these, so if somebody
+            # has changed them meanwhile - start over
+            if cls.objects.filter(id=row['id'], is_active=row['is_active'],
+                                  timezone=row['timezone']).update(**changes):
+                cls._count_active_change(
+                    row['is_active'], row['timezone'],
+                    True, changes.get('timezone', row['timezone'])
+                )
+                return row['id']
+    
+    @staticmethod
+    def _upsert_changes(row, fields):
+        """What should be updated in the stored row (dict) by upsert"""
+        changes = { f: v for f, v in fields.items() if row[f] != v }
+        # same as reactivate_if_needed()
+        if row['errors']:
+            changes['errors'] = 0
+        if not row['is_active']:
+            changes['is_active'] = True
+            changes['activated_at'] = timezone.now()
+        return changes
+    
+    @classmethod
+    def bulk_upsert(cls, items):
+        """
+        upsert() for many subscriptions at once. Receives a list of
+        (endpoint, fields dict, queued_at datetime) tuples, the last one
+        for the same endpoint wins. None instead of fields is a tombstone
+        of unsubscription queued before the subscription was saved.
+        
+        New subscriptions are saved by bulk INSERT, unchanged ones cost
+        nothing and changed ones are upsert() one by one. Subscription that
+        was deactivated after it's info had been queued stays deactivated.
+        """
+        latest = {}
+        field_names = {'timezone'}
+        for endpoint, fields, queued_at in items:
+            latest[endpoint] = (fields, queued_at)
+            field_names.update(fields or ())
+        
+        hashes = [ cls.hash_endpoint(endpoint) for endpoint in latest ]
+        rows = {}
+        for i in range(0, len(hashes), cls.BULK_CHUNK):
+            for row in cls.objects.filter(endpoint_hash__in=hashes[i:(i+cls.BULK_CHUNK)]) \
+                                  .values('endpoint', 'is_active', 'errors',
+                                          'deactivated_at', *field_names):
+                rows[row['endpoint']] = row
+        
+        new = []
+        changed = []
+        deactivated = []
+        now = timezone.now()
+        for endpoint, (fields, queued_at) in latest.items():
+            row = rows.get(endpoint)
+            if fields is None:
+                if row is not None and row['is_active']:
+                    deactivated.append(endpoint)
+                continue
+            if row is None:
+                new.append(cls(endpoint=endpoint, endpoint_hash=cls.hash_endpoint(endpoint),
+                               activated_at=now, **fields))
+            elif not row['is_active'] and row['deactivated_at'] is not None \
+                    and row['deactivated_at'] > queued_at:
+                continue  # unsubscribed after that
+            elif cls._upsert_changes(row, fields):
+                changed.append(endpoint)
+        
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(new, batch_size=cls.BULK_CHUNK)
+                if new:
+                    cls.count_active_by_timezone(Counter( s.timezone for s in new ))
+        except IntegrityError:
+            # some of them have just been saved by somebody else
+            changed.extend( s.endpoint for s in new )
+        for endpoint in changed:
+            cls.upsert(endpoint, **latest[endpoint][0])
+        for endpoint in deactivated:
+            cls.deactivate_endpoint(endpoint)
+        return len(latest)
+    
+    @classmethod
+    def deactivate_endpoint(cls, endpoint):
+        """
+        deactivate() subscription by it's endpoint without loading it.
+        Returns subscription id, raises DoesNotExist if there is no such one.
+        """
+        row = cls.by_endpoint(endpoint) \
+                         .values('id', 'is_active', 'timezone') \
+                         .get()
+        if row['is_active'] and \
+                cls.objects.filter(id=row['id'], is_active=True) \
+                           .update(is_active=False, deactivated_at=timezone.now()):
+            cls.count_active_by_timezone({ row['timezone']: -1 })
+        return row['id']
     
     @classmethod
     def count_active(cls):
         return cls.objects.filter(is_active=True).count()
     
+    @classmethod
+    def active_batches(cls, batch_size, after_id=0, **filters):
+        """
+        Generator of active subscription lists (batch_size max), ordered by id.
+        
+        Walks the table by id > last seen id instead of OFFSET, so every batch
+        costs the same no matter how deep in the table it is. Subscriptions
+        deactivated while we send don't shift the next batch either.
+        """
+        last_id = after_id
+        while True:
+            batch = list(
+                cls.objects.filter(is_active=True, id__gt=last_id, **filters) \
+                           .order_by('id')[:batch_size]
+            )
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1].id
+    
     def endpoint_truncated(self):
         return "%s..." % self.endpoint[0:64]
     endpoint_truncated.admin_order_field = 'endpoint'
@@ -107,6 +334,69 @@ class BaseSubscription(models.Model):
                     self.errors = 0
         return self
     
+    @classmethod
+    def bulk_errors_accounting(cls, error_points):
+        """
+        errors_accounting for many subscriptions at once.
+        
+        Receives a dict {quantity: [subscription ids]}. Error counters are
+        changed by a few set-based UPDATE queries with the database doing the
+        math (no read-modify-write races), subscriptions that reach
+        ERROR_THRESHOLD are deactivated by the same queries.
+        """
+        now = timezone.now()
+        deactivated = Counter()
+        with transaction.atomic():
+            for quantity, ids in error_points.items():
+                for i in range(0, len(ids), cls.BULK_CHUNK):
+                    qs = cls.objects.filter(pk__in=ids[i:(i+cls.BULK_CHUNK)])
+                    if quantity > 0:
+                        reaches_threshold = Q(errors__gte=(ERROR_THRESHOLD - quantity))
+                        deactivated.update(
+                            qs.select_for_update() \
+                              .filter(reaches_threshold, is_active=True) \
+                              .values_list('timezone', flat=True)
+                        )
+                        # MySQL evaluates SET from left to right with already
+                        # updated values, so errors column must be the last one
+                        qs.update(
+                            deactivated_at=Case(
+                                When(reaches_threshold & Q(is_active=True), then=Value(now)),
+                                default=F('deactivated_at'),
+                                output_field=models.DateTimeField()
+                            ),
+                            is_active=Case(
+                                When(reaches_threshold, then=Value(False)),
+                                default=F('is_active'),
+                                output_field=models.BooleanField()
+                            ),
+                            errors=F('errors') + quantity,
+                        )
+                    elif quantity < 0:
+                        # decrease error counter, but not below zero
+                        qs.filter(errors__gt=0).update(
+                            errors=Case(
+                                When(errors__lte=-quantity, then=Value(0)),
+                                default=F('errors') + quantity,
+                                output_field=models.PositiveIntegerField()
+                            )
+                        )
+            if deactivated:
+                cls.count_active_by_timezone({ tz: -n for tz, n in deactivated.items() })
+    
+    @classmethod
+    def bulk_deactivate(cls, ids):
+        """deactivate() for many subscriptions at once"""
+        for i in range(0, len(ids), cls.BULK_CHUNK):
+            with transaction.atomic():
+                qs = cls.objects.filter(pk__in=ids[i:(i+cls.BULK_CHUNK)], is_active=True)
+                deactivated = Counter(
+                    qs.select_for_update().values_list('timezone', flat=True)
+                )
+                qs.update(is_active=False, deactivated_at=timezone.now())
+                if deactivated:
+                    cls.count_active_by_timezone({ tz: -n for tz, n in deactivated.items() })
+    
     def push_service_response_to_errors(self, response_status, response_body):
         """
         Parse response from remote push-server.
@@ -114,12 +404,55 @@ class BaseSubscription(models.Model):
         Penalize erroneous subscriptions, removes points from successful delivery.
         Receives the response body of the push server (json str or dict).
         """
+        error_points, new_endpoint = self.push_service_response_error_points(
+            response_status, response_body
+        )
+        # check so we don't query database for no reason
+        if error_points > 0 or (error_points < 0 and self.errors > 0):
+            self.errors_accounting(error_points).save()
+        if new_endpoint is not None:
+            self.change_endpoint(new_endpoint)
+        return self
+    
+    def push_service_response_error_points(self, response_status, response_body):
+        """
+        Error points for the response from remote push-server (negative
+        for successful delivery, zero if there is nothing to count) and new
+        endpoint for the subscription if push-server gave us one (or None).
+        """
         if self.is_gcm():
-            return self.__fcm_push_service_response_to_errors(response_body)
+            return self.__fcm_push_service_response_error_points(response_body)
         else:
-            return self.__vapid_push_service_response_to_errors(response_status)
+            return (self.__vapid_push_service_response_error_points(response_status), None)
+    
+    def push_service_response_is_transient(self, response_status, response_body):
+        """
+        Push-server could not deliver right now, but the same request
+        should work later (retry is needed).
+        """
+        if response_status >= 500 or response_status == 429:
+            return True
+        if self.is_gcm() and response_status < 300:
+            try:
+                error_code = json.loads(response_body)['results'][0].get('error')
+            except (ValueError, KeyError, IndexError, TypeError):
+                return False
+            # The server couldn't process the request in time. Retry the same request
+            return error_code in ('Unavailable', 'InternalServerError',)
+        return False
     
-    def __vapid_push_service_response_to_errors(self, response_status):
+    def change_endpoint(self, new_endpoint):
+        self.endpoint = new_endpoint
+        try:
+            with transaction.atomic():
+                self.save(update_fields=['endpoint', 'endpoint_hash'])
+        except IntegrityError:
+            # Duplicate entry for endpoint - new canonical endpoint
+            # is already stored in the DB 
+            pass
+        return self
+    
+    def __vapid_push_service_response_error_points(self, response_status):
         # For non-success responses, an extended error code object will be returned
         # http://autopush.readthedocs.io/en/latest/http.html#response
         # https://developers.google.com/web/fundamentals/push-notifications/web-push-protocol#response_from_push_service
@@ -129,20 +462,15 @@ class BaseSubscription(models.Model):
                 error_points = 1
             elif response_status in (404, 410,):
                 error_points = 15
-            if error_points:
-                self.errors_accounting(error_points).save()
+            return error_points
         else:  # ok
-            # check so we don't query database for no reason
-            if self.errors > 0:
-                self.errors_accounting(-1).save()
-        return self
+            return -1
     
-    def __fcm_push_service_response_to_errors(self, response_body):
+    def __fcm_push_service_response_error_points(self, response_body):
         response_result = json.loads(response_body)['results'][0]  # part we need
         # ok, decrease error counter
         if 'message_id' in response_result:
-            if self.errors > 0:
-                self.errors_accounting(-1).save()
+            new_endpoint = None
             # If registration_id is set, replace the original ID with the new value
             # (canonical ID) in your server database.
             if 'registration_id' in response_result:
@@ -154,27 +482,21 @@ class BaseSubscription(models.Model):
                     url_validate(new_endpoint)
                 except ValidationError:
                     new_endpoint = "%s/%s" % (GCM_URL, new_endpoint)
-                self.endpoint = new_endpoint
-                try:
-                    self.save()
-                except IntegrityError:
-                    # Duplicate entry for endpoint - new canonical endpoint
-                    # is already stored in the DB 
-                    pass
+            return (-1, new_endpoint)
         elif 'error' in response_result:
             error_code = response_result['error']
             # https://firebase.google.com/docs/cloud-messaging/http-server-ref#error-codes
             if error_code in ('NotRegistered', 'InvalidRegistration',):
                 # google docs say we should turn off these subscriptions immediately
                 # but lets give them one more chance (based on testing responses manually)
-                self.errors_accounting(+15).save()
+                return (15, None)
             # The server couldn't process the request in time. Retry the same request
             elif error_code in ('Unavailable', 'InternalServerError',):
-                pass
+                return (0, None)
             # misc errors
             else:
-                self.errors_accounting(+1).save()
-        return self
+                return (1, None)
+        return (0, None)
 
 
 class DigestSubscription(BaseSubscription):
@@ -183,9 +505,79 @@ class DigestSubscription(BaseSubscription):
     class Meta:
         verbose_name = _('push subscription')
         verbose_name_plural = _('push subscriptions')
+        # One index per query, subscriptions is the largest table and every
+        # index costs on every write. Databases without partial indexes
+        # (MySQL) get the same indexes without condition.
+        indexes = [
+            # pushsend: active subscriptions of timezone(s) by id ranges,
+            # active subscribers counters
+            models.Index(fields=['timezone', 'id'], name='push_subscr_tz_id_if_active',
+                         condition=Q(is_active=True)),
+            # db clean-up: long ago deactivated subscriptions
+            models.Index(fields=['deactivated_at'], name='push_subscr_deact_if_inactive',
+                         condition=Q(is_active=False)),
+        ]
     
     def __str__(self):
         return _('subscription ID %(pk)d') % { 'pk': self.id }
+    
+    @classmethod
+    def count_active_by_timezone(cls, deltas):
+        TimezoneSubscribers.add(deltas)
+
+
+class TimezoneSubscribers(models.Model):
+    """
+    Active digest subscribers count by timezone, so pushsend knows which
+    timezone sub-tasks have nobody to send to without counting subscriptions.
+    
+    Subscriptions keep it up to date incrementally, recount() fixes whatever
+    was changed bypassing them (e.g. queryset updates or deletes).
+    """
+    timezone = models.CharField(_('timezone'), max_length=48, unique=True, editable=False)
+    active = models.IntegerField(_('active subscribers'), default=0, editable=False)
+    
+    class Meta:
+        verbose_name = _('timezone subscribers')
+        verbose_name_plural = _('timezone subscribers')
+    
+    def __str__(self):
+        return self.timezone
+    
+    @classmethod
+    def add(cls, deltas):
+        for tz, delta in deltas.items():
+            if cls.objects.filter(timezone=tz).update(active=F('active') + delta):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(timezone=tz, active=delta)
+            except IntegrityError:
+                # someone else has just created it
+                cls.objects.filter(timezone=tz).update(active=F('active') + delta)
+    
+    @classmethod
+    def recount(cls):
+        counts = dict(
+            DigestSubscription.objects.filter(is_active=True) \
+                                      .order_by() \
+                                      .values_list('timezone') \
+                                      .annotate(models.Count('id'))
+        )
+        with transaction.atomic():
+            for counter in cls.objects.select_for_update():
+                active = counts.pop(counter.timezone, 0)
+                if counter.active != active:
+                    counter.active = active
+                    counter.save(update_fields=['active'])
+            cls.objects.bulk_create([
+                cls(timezone=tz, active=active) for tz, active in counts.items()
+            ])
+    
+    @classmethod
+    def populated_timezones(cls):
+        """Timezones with active subscribers (queryset of timezone names)"""
+        return cls.objects.filter(active__gt=0).values_list('timezone', flat=True)
 
 
 class PublicTaskManager(models.Manager):
@@ -245,6 +637,17 @@ class Task(ModelWith2Images):
     def get_absolute_url(self):
         return reverse('push_show_notification', args=[self.id,])
     
+    def get_click_url(self):
+        """
+        Notification url with signed redirect target, so click on
+        notification is redirected without looking for task in db.
+        """
+        target = self.url_relative(add_querystring={'from': 'push'})
+        return "%s?%s" % (
+            self.get_absolute_url(),
+            urlencode({ 'to': signing.dumps([self.id, target], salt=CLICK_SALT) })
+        )
+    
     def is_done(self):
         return self.done_at is not None
     is_done.admin_order_field = 'done_at'
@@ -279,8 +682,12 @@ class Task(ModelWith2Images):
         if self.started_at is None:
             return None
         td = timedelta()
+        # layouts sent in one pass share the same start and end time
+        sent = set()
         for tzl in self.timezonelayout_set.all():
-            td = td + tzl.run_for()
+            if (tzl.started_at, tzl.done_at) not in sent:
+                sent.add( (tzl.started_at, tzl.done_at) )
+                td = td + tzl.run_for()
         if not with_microseconds:
             td = td - timedelta(microseconds=td.microseconds)
         return td if td != timedelta() else None
@@ -309,7 +716,7 @@ class Task(ModelWith2Images):
             'message': self.message,
             'icon': self.image.url if self.has_image() else DEFAULT_ICON_URL,
             'tag': 'notification-digest',
-            'url': self.get_absolute_url(),
+            'url': self.get_click_url(),
             'views_stat_url': reverse('push_notification_plus_one', args=['views', self.id,]),
             'closings_stat_url': reverse('push_notification_plus_one', args=['closings', self.id,]),
         }
@@ -325,14 +732,6 @@ class Task(ModelWith2Images):
         
         # sending time can be edited only for tasks that are not started yet
         if self.started_at is None:
-            # we check that task start time has changed by checking only
-            # one timezone (otherwise admin push interface will be very slow)
-            if len(pytz.all_timezones_set) == self.timezonelayout_set.count():
-                test_layout_tz = self.timezonelayout_set.get(timezone=settings.TIME_ZONE)
-                # empty timedelta means these datetimes are equal
-                if self.run_at - test_layout_tz.run_at == timedelta():
-                    return ret
-            
             # detect hour only(!) for project's default timezone
             default_tz = pytz.timezone(settings.TIME_ZONE)  # project's timezone
             run_at_in_default_tz = default_tz.normalize( self.run_at.astimezone(default_tz) )
@@ -341,21 +740,40 @@ class Task(ModelWith2Images):
             # e.g. 10 for 07:30:00 UTC == 10:30:00 Europe/Moscow
             run_at_hour = int(run_at_in_default_tz.hour)
             
-            # update layout db here
-            with transaction.atomic():
-                self.timezonelayout_set.all().delete()
-                for tz_str in pytz.all_timezones_set:
-                    tz = pytz.timezone(tz_str)
-                    tzed_run_at = tz.normalize( self.run_at.astimezone(tz) )
-                    # e.g. for Asia/Ekaterinburg it will be 10:30:00 Asia/Ekaterinburg
-                    tzed_run_at = tzed_run_at.replace(hour=run_at_hour)
-                    self.timezonelayout_set.create(
-                        timezone=tz_str,
-                        # Django ORM will change it to 05:30:00 UTC then saving
-                        # to db that does not support timezones (mysql)
-                        # TODO: wtf will happen for DB's that support timezones ???
-                        run_at=tzed_run_at
-                    )
+            layout_run_at = {}
+            for tz_str, offset in _timezone_offsets(self.run_at).items():
+                # e.g. for Asia/Ekaterinburg it will be 10:30:00 Asia/Ekaterinburg
+                # (05:30:00 UTC)
+                tzed_run_at = (self.run_at.astimezone(pytz.utc) + offset) \
+                              .replace(hour=run_at_hour)
+                layout_run_at[tz_str] = tzed_run_at - offset
+            
+            # update layout db here, only the rows whose time has changed
+            # (usually none, admin saves task on every edit)
+            changed = []
+            gone_ids = []  # timezones that are gone from pytz
+            for pk, tz_str, old_run_at in self.timezonelayout_set.values_list('id', 'timezone', 'run_at'):
+                run_at = layout_run_at.pop(tz_str, None)
+                if run_at is None:
+                    gone_ids.append(pk)
+                elif old_run_at != run_at:
+                    changed.append(TimezoneLayout(id=pk, run_at=run_at))
+            # whatever is left is new task (or new pytz timezones)
+            new = [
+                TimezoneLayout(task=self, timezone=tz_str, run_at=run_at)
+                for tz_str, run_at in layout_run_at.items()
+            ]
+            if changed or gone_ids or new:
+                with transaction.atomic():
+                    if gone_ids:
+                        TimezoneLayout.objects.filter(id__in=gone_ids).delete()
+                    TimezoneLayout.objects.bulk_update(changed, ['run_at'], batch_size=1000)
+                    TimezoneLayout.objects.bulk_create(new, batch_size=1000)
+        # readers must not cache (or wake up to) what admin's transaction
+        # may still roll back
+        transaction.on_commit(payload_cache.invalidate)
+        # sending schedule could change
+        transaction.on_commit(wakeup.notify)
         return ret
 
 
@@ -370,6 +788,16 @@ class UndoneTZLManager(models.Manager):
         ).order_by('run_at')
 
 
+class DueTZLManager(models.Manager):
+    """Timezone sub-tasks that have to be done, including already started"""
+    def get_queryset(self):
+        return super(DueTZLManager, self).get_queryset().filter(
+            task__is_active=True,
+            run_at__lte=timezone.now(),
+            done_at__isnull=True
+        ).order_by('run_at')
+
+
 class PublicTZLManager(models.Manager):
     """Push sub-tasks, that are already available for subscribers"""
     def get_queryset(self):
@@ -396,6 +824,7 @@ class TimezoneLayout(models.Model):
     
     objects = models.Manager()
     undone_objects = UndoneTZLManager()
+    due_objects = DueTZLManager()
     public_objects = PublicTZLManager()
     
     class Meta:
@@ -411,3 +840,265 @@ class TimezoneLayout(models.Model):
         if self.done_at is None or self.started_at is None:
             return timedelta()  # zero timedelta
         return self.done_at - self.started_at
+    
+    def finish(self):
+        """Mark as done (and the task too, if it was the last one)"""
+        now = timezone.now()
+        TimezoneLayout.objects.filter(pk=self.pk, done_at__isnull=True) \
+                              .update(done_at=now)
+        self.done_at = now
+        if self.task.all_timezones_done():
+            Task.objects.filter(pk=self.task_id, done_at__isnull=True) \
+                        .update(done_at=now)
+    
+    @classmethod
+    def finish_empty(cls):
+        """
+        Marks due sub-tasks of timezones without active subscribers as done
+        at once (there is nobody to send them to). Returns their number.
+        
+        Counters only point at candidates: they miss bulk and raw writes,
+        so every candidate timezone is checked for active subscribers.
+        """
+        candidates = list(
+            cls.undone_objects.exclude(timezone__in=TimezoneSubscribers.populated_timezones()) \
+                              .values_list('pk', 'task_id', 'timezone')
+        )
+        populated = set(
+            tz for tz in set( tz for pk, task_id, tz in candidates )
+            if DigestSubscription.objects.filter(is_active=True, timezone=tz).exists()
+        )
+        empty = [ (pk, task_id) for pk, task_id, tz in candidates if tz not in populated ]
+        now = timezone.now()
+        for i in range(0, len(empty), 1000):
+            cls.objects.filter(
+                pk__in=[ pk for pk, task_id in empty[i:(i+1000)] ],
+                started_at__isnull=True
+            ).update(started_at=now, done_at=now)
+        if empty:
+            payload_cache.invalidate()
+        for task in Task.objects.filter(pk__in=set( task_id for pk, task_id in empty )):
+            Task.objects.filter(pk=task.pk, started_at__isnull=True) \
+                        .update(started_at=now)
+            if task.all_timezones_done():
+                Task.objects.filter(pk=task.pk, done_at__isnull=True) \
+                            .update(done_at=now)
+        return len(empty)
+    
+    @classmethod
+    def next_run_at(cls):
+        """When the next sub-task that is not started yet should run (or None)"""
+        return cls.objects.filter(
+            task__is_active=True,
+            done_at__isnull=True,
+            started_at__isnull=True
+        ).order_by('run_at').values_list('run_at', flat=True).first()
+
+
+class SendShard(models.Model):
+    """
+    Subscription id range of a timezone sub-task, leased by one of several
+    pushsend processes (on different hosts) for sending.
+    
+    Lease is taken and prolonged (heartbeat) by conditional UPDATE queries,
+    so it works on every database backend. If the node dies, lease expires
+    and another node continues from the last id sent.
+    """
+    tz_layout = models.ForeignKey(TimezoneLayout, editable=False, on_delete=models.CASCADE)
+    id_from = models.PositiveIntegerField(editable=False)  # including
+    id_to = models.PositiveIntegerField(editable=False)  # excluding
+    last_id = models.PositiveIntegerField(default=0, editable=False)
+    leased_by = models.CharField(max_length=255, blank=True, default='', editable=False)
+    leased_until = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
+    done_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
+    
+    class Meta:
+        unique_together = ('tz_layout', 'id_from',)
+    
+    def __str__(self):
+        return _('ids %(id_from)d-%(id_to)d of %(tz_layout)s') % {
+            'id_from': self.id_from,
+            'id_to': self.id_to - 1,
+            'tz_layout': self.tz_layout,
+        }
+    
+    @classmethod
+    def start_layout(cls, tz_layout, shard_size):
+        """
+        Starts timezone sub-task (only one node succeeds) splitting it's
+        active subscribers to shards of shard_size. Boundaries are real ids,
+        so subscribers of a small timezone scattered over the whole table
+        don't make lots of empty shards.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            started = TimezoneLayout.objects \
+                .filter(pk=tz_layout.pk, started_at__isnull=True) \
+                .update(started_at=now)
+            if not started:
+                return
+            Task.objects.filter(pk=tz_layout.task_id, started_at__isnull=True) \
+                        .update(started_at=now)
+            transaction.on_commit(payload_cache.invalidate)
+            active_ids = DigestSubscription.objects \
+                .filter(timezone=tz_layout.timezone, is_active=True) \
+                .order_by('id').values_list('id', flat=True)
+            id_range = active_ids.aggregate(min_id=models.Min('id'), max_id=models.Max('id'))
+            if id_range['min_id'] is None:
+                tz_layout.finish()  # nobody to send to
+                return
+            # every shard_size-th id, each step is a short index range scan
+            boundaries = [id_range['min_id']]
+            while True:
+                next_ids = list(active_ids.filter(id__gt=boundaries[-1])[(shard_size-1):shard_size])
+                if not next_ids:
+                    break
+                boundaries.append(next_ids[0])
+            boundaries.append(id_range['max_id'] + 1)
+            cls.objects.bulk_create([
+                cls(tz_layout=tz_layout, id_from=id_from, id_to=id_to)
+                for id_from, id_to in zip(boundaries, boundaries[1:])
+            ], ignore_conflicts=True)
+    
+    @classmethod
+    def lease(cls, node, lease_seconds):
+        """Takes free (or expired) shard of the earliest layout, or None"""
+        now = timezone.now()
+        free = cls.objects.filter(
+            Q(leased_until__isnull=True) | Q(leased_until__lt=now),
+            done_at__isnull=True,
+            tz_layout__done_at__isnull=True,
+        ).order_by('tz_layout__run_at', 'id_from')
+        # others compete for the same shards, so try a few
+        for shard in free[:10]:
+            leased = cls.objects.filter(
+                Q(leased_until__isnull=True) | Q(leased_until__lt=now),
+                pk=shard.pk,
+                done_at__isnull=True,
+            ).update(leased_by=node, leased_until=now+timedelta(seconds=lease_seconds))
+            if leased:
+                shard.refresh_from_db()
+                return shard
+        return None
+    
+    def heartbeat(self, lease_seconds, last_id=None):
+        """
+        Prolongs the lease and remembers progress.
+        Returns False if the lease is lost (expired and taken by other node).
+        """
+        if last_id is not None:
+            self.last_id = last_id
+        self.leased_until = timezone.now() + timedelta(seconds=lease_seconds)
+        return bool(
+            SendShard.objects.filter(pk=self.pk, leased_by=self.leased_by) \
+                .update(leased_until=self.leased_until, last_id=self.last_id)
+        )
+    
+    def finish(self):
+        """Mark shard as done (and timezone sub-task, if it was the last one)"""
+        self.done_at = timezone.now()
+        SendShard.objects.filter(pk=self.pk, leased_by=self.leased_by) \
+                         .update(done_at=self.done_at)
+        if not SendShard.objects.filter(tz_layout_id=self.tz_layout_id,
+                                        done_at__isnull=True).exists():
+            self.tz_layout.finish()
+
+
+class RetryPush(models.Model):
+    """
+    Retry queue of pushes that failed for a transient reason (timeout,
+    5xx, 429...). Retried with exponential backoff until the deadline
+    (notification TTL since the first attempt).
+    """
+    subscription = models.ForeignKey(DigestSubscription, editable=False, on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, editable=False, on_delete=models.CASCADE)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    retry_at = models.DateTimeField(db_index=True, editable=False)
+    deadline = models.DateTimeField(db_index=True, editable=False)
+    claimed_by = models.CharField(max_length=255, blank=True, default='', editable=False)
+    
+    class Meta:
+        unique_together = ('subscription', 'task',)
+    
+    def __str__(self):
+        return _('retry of %(task)s for %(subscription)s') % {
+            'task': self.task,
+            'subscription': self.subscription,
+        }
+    
+    @staticmethod
+    def backoff(attempts, base_seconds):
+        return timedelta(seconds=base_seconds * 2 ** attempts)
+    
+    @classmethod
+    def schedule(cls, task, subscr_ids, ttl, base_seconds, retry_at=None):
+        """Adds failed pushes to the queue (ones already there are left as is)"""
+        now = timezone.now()
+        if retry_at is None:
+            retry_at = now + cls.backoff(0, base_seconds)
+        deadline = now + timedelta(seconds=ttl)
+        if not subscr_ids or retry_at >= deadline:
+            return
+        cls.objects.bulk_create([
+            cls(subscription_id=pk, task=task, retry_at=retry_at, deadline=deadline)
+            for pk in subscr_ids
+        ], ignore_conflicts=True)
+    
+    @classmethod
+    def next_retry_at(cls):
+        """When the next retry is due (or None if the queue is empty)"""
+        return cls.objects.order_by('retry_at').values_list('retry_at', flat=True).first()
+    
+    @classmethod
+    def claim_due(cls, node, batch_size, lease_seconds):
+        """
+        Generator of due retry lists (batch_size max). Every batch is claimed
+        by node for lease_seconds, so other pushsend processes skip it.
+        """
+        cls.objects.filter(deadline__lte=timezone.now()).delete()  # too late
+        last_id = 0
+        while True:
+            now = timezone.now()
+            ids = list(
+                cls.objects.filter(id__gt=last_id, retry_at__lte=now) \
+                           .order_by('id') \
+                           .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return
+            last_id = ids[-1]
+            cls.objects.filter(pk__in=ids, retry_at__lte=now) \
+                       .update(claimed_by=node,
+                               retry_at=now+timedelta(seconds=lease_seconds))
+            batch = list(
+                cls.objects.filter(pk__in=ids, claimed_by=node) \
+                           .select_related('subscription', 'task')
+            )
+            if batch:
+                yield batch
+    
+    @classmethod
+    def reschedule(cls, retries, failed_ids, base_seconds, max_attempts):
+        """
+        After retries were sent: removes done ones from the queue, schedules
+        failed ones for next attempt (or removes, if it is too late).
+        """
+        now = timezone.now()
+        done = []
+        by_attempts = defaultdict(list)
+        for retry in retries:
+            attempts = retry.attempts + 1
+            if retry.subscription_id in failed_ids \
+            and attempts < max_attempts \
+            and now + cls.backoff(attempts, base_seconds) < retry.deadline:
+                by_attempts[attempts].append(retry.pk)
+            else:
+                done.append(retry.pk)
+        with transaction.atomic():
+            cls.objects.filter(pk__in=done).delete()
+            for attempts, ids in by_attempts.items():
+                cls.objects.filter(pk__in=ids).update(
+                    attempts=attempts,
+                    retry_at=now+cls.backoff(attempts, base_seconds),
+                    claimed_by=''
+                )
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import caches
+
+from .settings import CACHE, LAST_NOTIFICATION_CACHE_TIMEOUT
+
+
+# every invalidation starts a new generation of keys,
+# so we don't have to delete ~600 timezone keys one by one
+VERSION_KEY = 'push:last_notification:version'
+
+
+def _key(cache, tz):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return 'push:last_notification:%d:%s' % (version, tz)
+
+
+def get(tz):
+    """
+    (task id, payload) of the last notification for the timezone,
+    (None, None) if there is no notification and None if it's not cached.
+    """
+    cache = caches[CACHE]
+    return cache.get(_key(cache, tz))
+
+
+def set(tz, task_id, payload):
+    cache = caches[CACHE]
+    cache.set(_key(cache, tz), (task_id, payload), LAST_NOTIFICATION_CACHE_TIMEOUT)
+
+
+def invalidate():
+    """Last notification has changed (for some of the timezones at least)"""
+    cache = caches[CACHE]
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, timeout=None)
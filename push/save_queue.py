@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import caches
+from django.utils import timezone
+
+from .settings import CACHE, SAVE_QUEUE_SIZE
+from .models import DigestSubscription
+
+
+# queue is a numbered sequence of cache keys: save view takes the next
+# number from TAIL_KEY, pushsend saves them up to that number and moves
+# HEAD_KEY (one pushsend at a time, sharded ones take LOCK_KEY)
+HEAD_KEY = 'push:save_queue:head'
+TAIL_KEY = 'push:save_queue:tail'
+LOCK_KEY = 'push:save_queue:lock'
+# lock is gone by itself if pushsend dies while saving
+LOCK_TIMEOUT = 10 * 60
+# queued subscription is lost if nobody saves it for this long
+ITEM_TIMEOUT = 24 * 60 * 60
+# missing items this close to the tail are probably being put right now
+WRITING_WINDOW = 100
+
+
+def _item_key(n):
+    return 'push:save_queue:%d' % n
+
+
+def _pending_key(endpoint):
+    return 'push:save_queue:pending:%s' % DigestSubscription.hash_endpoint(endpoint)
+
+
+def put(endpoint, fields):
+    """
+    Queues subscription info for saving, fields=None is a tombstone:
+    the subscription is deactivated (or not created at all) on flush.
+    Returns False if the queue is full (the caller has to save it by itself then).
+    """
+    cache = caches[CACHE]
+    try:
+        tail = cache.incr(TAIL_KEY)
+    except ValueError:
+        cache.add(TAIL_KEY, 0, timeout=None)
+        tail = cache.incr(TAIL_KEY)
+    if tail - cache.get(HEAD_KEY, 0) > SAVE_QUEUE_SIZE:
+        return False  # number is wasted, flush() will skip it
+    cache.set(_item_key(tail), (endpoint, fields, timezone.now()), ITEM_TIMEOUT)
+    if fields is not None:
+        cache.set(_pending_key(endpoint), True, ITEM_TIMEOUT)
+    return True
+
+
+def pending(endpoint):
+    """Was subscription queued recently (it may be not in db yet)"""
+    return bool(caches[CACHE].get(_pending_key(endpoint)))
+
+
+def flush(batch_size=DigestSubscription.BULK_CHUNK):
+    """Saves queued subscriptions to db, returns their number"""
+    cache = caches[CACHE]
+    if not cache.add(LOCK_KEY, True, LOCK_TIMEOUT):
+        return 0  # other pushsend is saving them right now
+    try:
+        return _flush(cache, batch_size)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def _flush(cache, batch_size):
+    head = cache.get(HEAD_KEY, 0)
+    tail = cache.get(TAIL_KEY, 0)
+    saved = 0
+    while head < tail:
+        numbers = range(head + 1, min(tail, head + batch_size) + 1)
+        keys = [ _item_key(n) for n in numbers ]
+        found = cache.get_many(keys)
+        items = []
+        for n, key in zip(numbers, keys):
+            if key not in found and tail - n < WRITING_WINDOW:
+                break  # come back for it next time
+            if key in found:
+                items.append(found[key])
+            head = n
+        if items:
+            DigestSubscription.bulk_upsert(items)
+            saved += len(items)
+        cache.set(HEAD_KEY, head, timeout=None)
+        cache.delete_many([ _item_key(n) for n in numbers if n <= head ])
+        if head < numbers[-1]:
+            break
+    return saved
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+from pywebpush import WebPusher
+from py_vapid import Vapid
+import requests
+import requests.adapters
+from requests import exceptions as requests_ex
+try:
+    import httpx
+    import h2  # noqa, httpx needs it for HTTP/2
+except ImportError:  # optional, only needed for async engine
+    httpx = None
+
+import time
+import json
+import base64
+import asyncio
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from .settings import GCM_URL, FCM_URL, PUSHSEND_POOL_ORIGINS, \
+                      PUSHSEND_POOL_SIZE, PUSHSEND_POOL_KEEPALIVE, \
+                      PUSHSEND_ORIGIN_RATE, PUSHSEND_BREAKER_ERRORS, \
+                      PUSHSEND_BREAKER_PAUSE, PUSHSEND_MAX_WAIT
+from .limiter import OriginLimiter
+
+
+# Picklable replacement for http library response objects, so results
+# of every engine look the same for the pushsend management command.
+# elapsed is push service response time in seconds.
+PushResponse = namedtuple('PushResponse', ['status_code', 'text', 'headers', 'elapsed'],
+                          defaults=(None,))
+
+# exceptions meaning that subscription endpoint is not an url at all
+INVALID_ENDPOINT_EXCEPTIONS = (requests_ex.InvalidURL, requests_ex.URLRequired,)
+# exceptions meaning that the same request should work later
+TRANSIENT_EXCEPTIONS = (requests_ex.Timeout, requests_ex.ConnectionError,)
+if httpx is not None:
+    INVALID_ENDPOINT_EXCEPTIONS += (httpx.InvalidURL, httpx.UnsupportedProtocol,)
+    TRANSIENT_EXCEPTIONS += (httpx.TimeoutException, httpx.NetworkError,
+                             httpx.RemoteProtocolError,)
+
+
+def endpoint_origin(endpoint):
+    """scheme://host[:port] part of endpoint url (VAPID aud claim)"""
+    url = urlparse(endpoint)
+    return "%s://%s" % (url.scheme, url.netloc)
+
+
+class VapidHeadersCache(object):
+    """
+    Signed VAPID auth headers by push service origin.
+
+    JWT claims differ only by push service origin (aud), so one signature
+    serves every request to that push service until it is close to its
+    expiration, instead of signing a new JWT for every single request.
+    """
+
+    # same expiration as pywebpush uses (12 hours)
+    LIFETIME = 12 * 60 * 60
+    # re-sign this long before expiration, so push service never gets
+    # a token that expires while the request is on it's way
+    REFRESH_BEFORE = 60 * 60
+
+    def __init__(self, vapid, vapid_email):
+        self.vapid = vapid
+        self.vapid_email = vapid_email
+        self._cache = {}  # origin: (exp, headers)
+
+    def get(self, endpoint):
+        origin = endpoint_origin(endpoint)
+        now = int(time.time())
+        try:
+            exp, headers = self._cache[origin]
+            if exp - self.REFRESH_BEFORE > now:
+                return headers
+        except KeyError:
+            pass
+        # expiry window is over (or never started) for this origin,
+        # so drop everything that is expired and sign again
+        self.evict(now)
+        exp = now + self.LIFETIME
+        headers = self.vapid.sign({
+            "sub": "mailto:"+self.vapid_email,
+            "aud": origin,
+            "exp": exp,
+        })
+        self._cache[origin] = (exp, headers)
+        return headers
+
+    def evict(self, now=None):
+        if now is None:
+            now = int(time.time())
+        for origin, (exp, headers) in list(self._cache.items()):
+            if exp - self.REFRESH_BEFORE <= now:
+                del self._cache[origin]
+
+
+def build_push_request(subscr, payload, ttl, gcm_key, vapid_headers):
+    """
+    Encrypt payload and prepare everything to send it to push service
+    without sending (so any http client can do the job).
+
+    vapid_headers are signed VAPID auth headers for subscription's push
+    service (not used for legacy GCM/FCM subscriptions).
+
+    Returns (url, body, headers) tuple.
+    """
+    data = payload if subscr.supports_payload() else None
+    # seems to be the only encoding legacy chrome understands
+    # for payload encryption
+    content_encoding = "aesgcm" if subscr.is_gcm() else "aes128gcm"
+    headers = {"ttl": str(ttl)}
+    body = None
+
+    if data:
+        encoded = WebPusher(subscr.endpoint_and_keys()).encode(
+            data.encode('utf8'), content_encoding
+        )
+        if "crypto_key" in encoded:
+            headers["crypto-key"] = "dh=" + encoded["crypto_key"].decode("utf8")
+        if "salt" in encoded:
+            headers["encryption"] = "salt=" + encoded["salt"].decode("utf8")
+        headers["content-encoding"] = content_encoding
+        body = encoded["body"]
+
+    if subscr.is_gcm() and gcm_key:
+        # same as pywebpush does it for legacy GCM/FCM projects:
+        # gcm keys are all about 40 chars, fcm keys are 153-175 chars
+        url = GCM_URL if len(gcm_key) < 100 else FCM_URL
+        gcm_data = {
+            "registration_ids": [subscr.endpoint.rsplit('/', 1)[-1],],
+            "time_to_live": int(ttl),
+        }
+        if body:
+            gcm_data["raw_data"] = base64.b64encode(body).decode("utf8")
+        body = json.dumps(gcm_data)
+        headers.update({
+            "Authorization": "key="+gcm_key,
+            "Content-Type": "application/json",
+        })
+    else:
+        # legacy subscription without gcm key goes to it's endpoint
+        # as it is, like pywebpush sends it
+        url = subscr.endpoint
+        if vapid_headers:
+            headers.update(vapid_headers)
+
+    return (url, body, headers)
+
+
+# Per process state of push workers. Filled once by init_push_worker and
+# kept warm between batches: signed VAPID headers, http session or client.
+_worker = {}
+
+
+def init_push_worker(engine, ttl, gcm_key, vapid_key, vapid_email):
+    """Pool initializer (also called directly if there is no pool)"""
+    _worker.clear()
+    if vapid_key:
+        vapid = Vapid.from_string(private_key=vapid_key)
+    else:
+        vapid = None
+    _worker.update({
+        'engine': engine,
+        'ttl': ttl,
+        'gcm_key': gcm_key,
+        'vapid_headers': VapidHeadersCache(vapid, vapid_email),
+        'limiter': OriginLimiter(
+            rate=PUSHSEND_ORIGIN_RATE,
+            breaker_errors=PUSHSEND_BREAKER_ERRORS,
+            breaker_pause=PUSHSEND_BREAKER_PAUSE,
+            max_wait=PUSHSEND_MAX_WAIT
+        ),
+    })
+    if engine == 'async':
+        _worker['loop'] = asyncio.new_event_loop()
+        _worker['client'] = None  # must be created inside the loop
+    else:
+        # keep-alive connection pool for every push service origin
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=PUSHSEND_POOL_ORIGINS,
+            pool_maxsize=PUSHSEND_POOL_SIZE
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _worker['session'] = session
+
+
+def close_push_worker():
+    """Free what init_push_worker opened (for in-process workers)"""
+    if _worker.get('session') is not None:
+        _worker['session'].close()
+    if _worker.get('loop') is not None:
+        if _worker['client'] is not None:
+            _worker['loop'].run_until_complete(_worker['client'].aclose())
+        _worker['loop'].close()
+    _worker.clear()
+
+
+def _build_push_request(subscr, payload):
+    if subscr.is_gcm():
+        vapid_headers = None
+    else:
+        vapid_headers = _worker['vapid_headers'].get(subscr.endpoint)
+    return build_push_request(
+        subscr, payload, _worker['ttl'], _worker['gcm_key'], vapid_headers
+    )
+
+
+# must be top level function to be used in Pool
+# receives only 1 param (tuple with all data)
+def send_push_worker(data):
+    subscr_list, payload = data
+    limiter = _worker['limiter']
+
+    responses = []
+    exceptions = []  # can't use logger in a worker
+    deferred = []  # push service asked us to come back later
+    for subscr in subscr_list:
+        try:
+            url, body, headers = _build_push_request(subscr, payload)
+            origin = endpoint_origin(url)
+            delay = limiter.delay(origin)
+            if delay is None:
+                deferred.append( (subscr, limiter.paused_until(origin),) )
+                continue
+            if delay:
+                time.sleep(delay)
+            try:
+                response = _worker['session'].post(
+                    url, data=body, headers=headers, timeout=3.0
+                )
+            except TRANSIENT_EXCEPTIONS:
+                # broken endpoint of one subscriber says nothing about
+                # the push service
+                limiter.failure(origin)
+                raise
+            limiter.response(origin, response.status_code, response.headers)
+            responses.append(
+                (subscr, PushResponse(response.status_code, response.text,
+                                      dict(response.headers),
+                                      response.elapsed.total_seconds()))
+            )
+        except Exception as e:
+            exceptions.append( (subscr, e, time.time(),) )
+
+    return (responses, exceptions, deferred)
+
+
+def _async_client():
+    if _worker['client'] is None:
+        # one HTTP/2 connection per push service multiplexes all the requests
+        # to it, client lives as long as the worker process
+        _worker['client'] = httpx.AsyncClient(
+            http2=True,
+            timeout=3.0,
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=PUSHSEND_POOL_ORIGINS * PUSHSEND_POOL_SIZE,
+                keepalive_expiry=PUSHSEND_POOL_KEEPALIVE
+            )
+        )
+    return _worker['client']
+
+
+# must be top level function to be used in Pool
+def warm_push_worker(origins):
+    """
+    Opens (or refreshes) keep-alive connections to push services, so DNS,
+    TCP and TLS handshakes are done before sending starts.
+    """
+    if _worker['engine'] == 'async':
+        _worker['loop'].run_until_complete(_warm_async(origins))
+    else:
+        for origin in origins:
+            try:
+                _worker['session'].head(origin, timeout=3.0)
+            except Exception:
+                pass  # it's just a warm up, sending will tell what's wrong
+
+
+async def _warm_async(origins):
+    client = _async_client()
+    async def warm_one(origin):
+        try:
+            await client.head(origin)
+        except Exception:
+            pass  # it's just a warm up, sending will tell what's wrong
+    await asyncio.gather(*[ warm_one(o) for o in origins ])
+
+
+async def _send_push_async(subscr_list, payload):
+    # all of them are sent at once, pushsend makes chunks no bigger than
+    # PUSHSEND_ASYNC_CONCURRENCY and worker sends one chunk at a time
+    client = _async_client()
+    limiter = _worker['limiter']
+
+    responses = []
+    exceptions = []
+    deferred = []
+
+    async def send_one(subscr):
+        try:
+            url, body, headers = _build_push_request(subscr, payload)
+            origin = endpoint_origin(url)
+            delay = limiter.delay(origin)
+            if delay is None:
+                deferred.append( (subscr, limiter.paused_until(origin),) )
+                return
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                response = await client.post(url, content=body, headers=headers)
+            except TRANSIENT_EXCEPTIONS:
+                limiter.failure(origin)
+                raise
+            limiter.response(origin, response.status_code, response.headers)
+            responses.append(
+                (subscr, PushResponse(response.status_code, response.text,
+                                      dict(response.headers),
+                                      response.elapsed.total_seconds()))
+            )
+        except Exception as e:
+            exceptions.append( (subscr, e, time.time(),) )
+
+    await asyncio.gather(*[ send_one(s) for s in subscr_list ])
+
+    return (responses, exceptions, deferred)
+
+
+# same interface as send_push_worker, but sends with asyncio over HTTP/2
+def send_push_worker_async(data):
+    subscr_list, payload = data
+    return _worker['loop'].run_until_complete(
+        _send_push_async(subscr_list, payload)
+    )
+
+
+ENGINES = {
+    'sync': send_push_worker,
+    'async': send_push_worker_async,
+}
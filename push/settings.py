@@ -11,6 +11,61 @@ FCM_SENDER_ID = getattr(settings, 'DJANGO_INFOPUSH_FCM_SENDER_ID', '')
 # how many processes to use in a pushsend management command for parallel push
 # 1 disables multiprocessing
 PUSHSEND_WORKERS = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_WORKERS', 3))
+# pushsend workers return results (and parent process does error accounting)
+# by chunks of this many subscriptions (sync engine)
+PUSHSEND_RESULT_CHUNK = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_RESULT_CHUNK', 200))
+# 'sync' (one blocking request at a time per worker) or 'async' (asyncio and
+# HTTP/2, needs httpx[http2] installed)
+PUSHSEND_ENGINE = getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_ENGINE', 'sync')
+# max simultaneous requests per worker process for async engine
+PUSHSEND_ASYNC_CONCURRENCY = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_ASYNC_CONCURRENCY', 1000))
+# keep-alive connections of every pushsend worker process:
+# for how many push service origins and how many connections per origin
+PUSHSEND_POOL_ORIGINS = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_POOL_ORIGINS', 10))
+PUSHSEND_POOL_SIZE = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_POOL_SIZE', 10))
+# seconds an idle connection is kept open (async engine)
+PUSHSEND_POOL_KEEPALIVE = float(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_POOL_KEEPALIVE', 60))
+# push services to connect to before sending starts (DNS, TLS handshakes)
+PUSHSEND_PREWARM_ORIGINS = getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_PREWARM_ORIGINS', [
+    'https://fcm.googleapis.com',
+    'https://updates.push.services.mozilla.com',
+])
+
+# requests per second to one push service from one pushsend worker process
+# (0 - no limit)
+PUSHSEND_ORIGIN_RATE = float(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_ORIGIN_RATE', 0))
+# circuit breaker: push service is paused for PAUSE seconds after this many
+# 5xx responses (or connection errors) in a row
+PUSHSEND_BREAKER_ERRORS = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_BREAKER_ERRORS', 50))
+PUSHSEND_BREAKER_PAUSE = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_BREAKER_PAUSE', 60))
+# seconds worker may wait for paused push service, if it's paused for longer
+# the subscriptions are deferred until the end of the run
+PUSHSEND_MAX_WAIT = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_MAX_WAIT', 5))
+# seconds pushsend may wait at the end of the run to send deferred subscriptions
+PUSHSEND_DEFERRED_MAX_WAIT = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_DEFERRED_MAX_WAIT', 300))
+
+# retry queue for pushes that failed for a transient reason (timeouts, 5xx...),
+# first retry in RETRY_BASE seconds, then 2x longer every next attempt,
+# but no more than RETRY_ATTEMPTS retries (and not after notification TTL)
+PUSHSEND_RETRY_BASE = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_RETRY_BASE', 60))
+PUSHSEND_RETRY_ATTEMPTS = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_RETRY_ATTEMPTS', 5))
+
+# file for metrics of the last pushsend run (Prometheus textfile if it ends
+# with .prom, JSON report otherwise), empty string - no metrics file
+PUSHSEND_METRICS_FILE = str(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_METRICS_FILE', ''))
+
+# seconds, pushsend --daemon sleeps no longer than this even if there is
+# nothing to send (stats flush, save queue, db clean-up, sharded mode leases)
+PUSHSEND_DAEMON_MAX_SLEEP = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_DAEMON_MAX_SLEEP', 60))
+
+# sharded mode: several pushsend processes on different hosts share the work
+# leasing subscriber id ranges (shards) of timezone layouts from DB
+PUSHSEND_SHARDED = bool(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_SHARDED', False))
+# active subscribers per shard
+PUSHSEND_SHARD_SIZE = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_SHARD_SIZE', 100000))
+# seconds, node must send next batch of it's shard in this time, or another
+# node will take the shard
+PUSHSEND_SHARD_LEASE = int(getattr(settings, 'DJANGO_INFOPUSH_PUSHSEND_SHARD_LEASE', 600))
 
 # default push icon
 DEFAULT_ICON_URL = getattr(settings, 'DJANGO_INFOPUSH_DEFAULT_ICON_URL', "/static/push/img/icon.png")
@@ -36,9 +91,25 @@ APP_THEME_COLOR = getattr(settings, 'DJANGO_INFOPUSH_APP_THEME_COLOR', None)
 # optional, https://developers.google.com/web/tools/lighthouse/audits/custom-splash-screen
 APP_BACKGROUND_COLOR = getattr(settings, 'DJANGO_INFOPUSH_APP_BACKGROUND_COLOR', None)
 
+# save view puts subscriptions to a queue in cache, pushsend saves them
+# to db in bulk (for subscription prompt on every page of a busy site)
+SAVE_QUEUE = bool(getattr(settings, 'DJANGO_INFOPUSH_SAVE_QUEUE', False))
+# max queued subscriptions, save view writes to db right away if it's full
+SAVE_QUEUE_SIZE = int(getattr(settings, 'DJANGO_INFOPUSH_SAVE_QUEUE_SIZE', 100000))
+
 # error threshold after which we disable push subscription
 ERROR_THRESHOLD = int(getattr(settings, 'DJANGO_INFOPUSH_ERROR_THRESHOLD', 30))
 
+# seconds, task views/clicks/closings are counted in cache and written to db
+# not more often than this (0 - write every single one right away), needs
+# a cache shared by web server and pushsend processes
+STATS_FLUSH_INTERVAL = int(getattr(settings, 'DJANGO_INFOPUSH_STATS_FLUSH_INTERVAL', 0))
+# cache alias for buffered statistics and last notification payloads
+CACHE = getattr(settings, 'DJANGO_INFOPUSH_CACHE', 'default')
+# seconds, last notification payload (for subscribers without payload
+# support) is cached for this long at most
+LAST_NOTIFICATION_CACHE_TIMEOUT = int(getattr(settings, 'DJANGO_INFOPUSH_LAST_NOTIFICATION_CACHE_TIMEOUT', 60))
+
 # do not change, it is here for easy import of this constant
 GCM_URL = 'https://android.googleapis.com/gcm/send'
 FCM_URL = 'https://fcm.googleapis.com/fcm/send'
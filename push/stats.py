@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+
+from .settings import STATS_FLUSH_INTERVAL, CACHE
+from .models import Task
+
+
+STATS_FIELDS = ('views', 'clicks', 'closings',)
+
+# notifications are hardly ever seen or clicked after that
+RECENT_TASKS_DAYS = 31
+
+
+def _key(what, task_id):
+    return 'push:stats:%s:%d' % (what, task_id)
+
+
+def count(what, task_id):
+    """
+    +1 to task views, clicks or closings.
+    
+    Increments are summed up in cache and the first request after
+    STATS_FLUSH_INTERVAL writes them to task with one UPDATE query, so
+    a push delivered to a million browsers at once does not turn into
+    a million UPDATEs of the same row.
+    """
+    if not STATS_FLUSH_INTERVAL:
+        Task.objects.filter(pk=task_id).update(**{ what: F(what) + 1 })
+        return
+    cache = caches[CACHE]
+    key = _key(what, task_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)  # someone has just added it
+    flush(task_id)
+
+
+def flush(task_id):
+    """
+    Writes task counters from cache to db (if nobody did it for the last
+    STATS_FLUSH_INTERVAL seconds).
+    """
+    cache = caches[CACHE]
+    if not cache.add(_key('flushed', task_id), 1, timeout=STATS_FLUSH_INTERVAL):
+        return
+    keys = { what: _key(what, task_id) for what in STATS_FIELDS }
+    values = cache.get_many(keys.values())
+    increments = {}
+    for what, key in keys.items():
+        if values.get(key):
+            increments[what] = values[key]
+    if not increments:
+        return
+    Task.objects.filter(pk=task_id).update(**{
+        what: F(what) + n for what, n in increments.items()
+    })
+    # decr, not delete: new views may have been counted meanwhile
+    for what, n in increments.items():
+        cache.decr(keys[what], n)
+
+
+def flush_recent():
+    """Writes out what is left in cache for recently sent tasks"""
+    if not STATS_FLUSH_INTERVAL:
+        return
+    tasks = Task.public_objects.filter(
+        started_at__gte=( timezone.now() - timedelta(days=RECENT_TASKS_DAYS) )
+    )
+    for task_id in tasks.values_list('id', flat=True):
+        flush(task_id)
@@ -84,6 +84,13 @@ self.addEventListener('push', function(event) {
         //{# This is a Django template call, because you are actually #}
         //{# viewing a django template file, not static js. #}
         var last_notification_url = '{% url "push_last_notification" %}';
+        try {
+            last_notification_url += '?timezone=' + encodeURIComponent(
+                Intl.DateTimeFormat().resolvedOptions().timeZone
+            );
+        } catch (e) {
+            //{# default timezone then #}
+        }
         promises = fetch(last_notification_url, {
             method: 'GET',
             credentials: 'include'
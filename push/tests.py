@@ -1,9 +1,20 @@
 import string
 import random
-from unittest import skipUnless
+import base64
+import os
+import time
+import json
+import signal
+import tempfile
+import pytz
+import requests
+from contextlib import contextmanager
+from unittest import skipUnless, mock
 from datetime import timedelta
 
 from django.test import TestCase, override_settings
+from django.db import connection, transaction, IntegrityError
+from django.core.cache import caches
 from django.urls import reverse
 from django.conf import settings
 from django.utils import translation, timezone
@@ -11,9 +22,24 @@ from io import StringIO
 from urllib.parse import urlsplit, urlunsplit
 from django.contrib.sites.models import Site
 from django.core.management import call_command
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+from py_vapid import Vapid
 
-from .settings import GCM_URL, FCM_SENDER_ID
-from .models import DigestSubscription, Task
+from .settings import GCM_URL, FCM_SENDER_ID, VAPID_PRIVATE_KEY, \
+                      VAPID_ADMIN_EMAIL, ERROR_THRESHOLD, PUSHSEND_POOL_SIZE, \
+                      CACHE
+from .models import DigestSubscription, Task, TimezoneLayout, SendShard, \
+                    RetryPush, TimezoneSubscribers
+from . import sender, stats, save_queue, wakeup
+from .management.commands.pushsend import Command as PushsendCommand
+from .management.commands.pushexport import Command as PushexportCommand
+from .management.commands.pushbench import FakePushService, percentile
+from .management.commands.pushseed import Command as PushseedCommand, DEFAULT_SPEC
+from .metrics import RunMetrics
+from .limiter import OriginLimiter, parse_retry_after
+from .sender import build_push_request, VapidHeadersCache, httpx, \
+                    init_push_worker, close_push_worker, warm_push_worker
 
 
 def __fake_letters(length=10):
@@ -31,6 +57,17 @@ def _new_subscription_obj_for_test(is_active=True):
     return s
 
 
+def _new_subscription_keys_for_test():
+    """Real browser-like p256dh and auth keys, so payload can be encrypted"""
+    public_key = ec.generate_private_key(ec.SECP256R1()).public_key()
+    p256dh = public_key.public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.UncompressedPoint
+    )
+    b64 = lambda b: base64.urlsafe_b64encode(b).strip(b'=').decode('utf8')
+    return (b64(p256dh), b64(os.urandom(16)))
+
+
 def _new_task_obj_for_test(is_active=True, run_at=None, started_at=None, done_at=None):
     t = Task()
     t.title = __fake_letters(10)
@@ -52,7 +89,51 @@ def _new_task_obj_for_test(is_active=True, run_at=None, started_at=None, done_at
     return t
 
 
+def _pushsend_command_for_test():
+    """pushsend command ready to call it's steps one by one (sync engine)"""
+    cmd = PushsendCommand()
+    cmd.engine = 'sync'
+    cmd.deferred = []
+    cmd.payloads = {}
+    cmd.metrics = RunMetrics()
+    return cmd
+
+
+def _pushsend_send_for_test(subscr_list):
+    """Sends by one in-process worker, returns list of results by chunks"""
+    with mock.patch('push.management.commands.pushsend.PUSHSEND_WORKERS', 1):
+        cmd = _pushsend_command_for_test()
+        try:
+            return list(cmd.send(subscr_list, '{}'))
+        finally:
+            cmd.stop_workers()
+
+
+def _all_pushes_ok_for_test(subscr_list, payload):
+    yield ([ (s, sender.PushResponse(201, '', {})) for s in subscr_list ], [], [])
+
+
+@contextmanager
+def _fake_push_services_for_test(send=_all_pushes_ok_for_test):
+    """
+    pushsend gets results from send(subscr_list, payload) generator
+    instead of push services (and doesn't warm them up)
+    """
+    with mock.patch.object(PushsendCommand, 'send', side_effect=send), \
+         mock.patch('push.management.commands.pushsend.PUSHSEND_PREWARM_ORIGINS', []):
+        yield
+
+
+# never touch the cache of the project (it could be production memcached)
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    CACHE: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+})
 class PushTests(TestCase):
+    def setUp(self):
+        # buffered statistics of the tasks with the same ids from other tests
+        caches[CACHE].clear()
+    
     def test_push_on_off_view_working(self):
         response = self.client.get(reverse('push_on_off'))
         self.assertContains(response, 'js-push-button')
@@ -86,6 +167,9 @@ class PushTests(TestCase):
         self.assertEqual(int(response.json()['response']['id']), obj.pk)
         obj.refresh_from_db()
         self.assertFalse(obj.is_active)
+        # no endpoint at all
+        response = self.client.post(reverse('push_deactivate'), {})
+        self.assertEqual(response.status_code, 404)
     
     @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
     def test_last_notification_view(self):
@@ -128,4 +212,738 @@ class PushTests(TestCase):
         task.refresh_from_db()
         self.assertTrue(task.done_at is not None)
         self.assertTrue(task.started_at is not None)
-    
\ No newline at end of file
+        
+    def test_build_push_request_encrypts_and_signs(self):
+        subscr = _new_subscription_obj_for_test(True)
+        subscr.key, subscr.auth_secret = _new_subscription_keys_for_test()
+        vapid_headers = VapidHeadersCache(
+            Vapid.from_string(private_key=VAPID_PRIVATE_KEY), VAPID_ADMIN_EMAIL
+        ).get(subscr.endpoint)
+        url, body, headers = build_push_request(
+            subscr, '{"title": "test"}', 60, '', vapid_headers
+        )
+        self.assertEqual(url, subscr.endpoint)
+        self.assertTrue(body)
+        self.assertEqual(headers['ttl'], '60')
+        self.assertEqual(headers['content-encoding'], 'aes128gcm')
+        self.assertTrue(headers['Authorization'].startswith('vapid '))
+        
+        # legacy GCM subscription goes to GCM only with a key
+        subscr.endpoint = GCM_URL + '/hstwtdjsyTDSDGSU'
+        url, body, headers = build_push_request(subscr, '{"title": "test"}', 60, '', None)
+        self.assertEqual(url, subscr.endpoint)
+        self.assertNotIn('Authorization', headers)
+        url, body, headers = build_push_request(subscr, '{"title": "test"}', 60, 'k' * 39, None)
+        self.assertEqual(url, GCM_URL)
+        self.assertEqual(headers['Authorization'], 'key=' + 'k' * 39)
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    @skipUnless(httpx, "Async pushsend engine needs httpx[http2] installed.")
+    def test_pushsend_management_command_async_engine(self):
+        _new_subscription_obj_for_test(True)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        call_command('pushsend', engine='async', stdout=StringIO())
+        task.refresh_from_db()
+        self.assertTrue(task.done_at is not None)
+        self.assertTrue(task.started_at is not None)
+    
+    def test_active_batches_walk_all_active_subscriptions(self):
+        active = [ _new_subscription_obj_for_test(True) for i in range(5) ]
+        _new_subscription_obj_for_test(False)
+        batches = list(DigestSubscription.active_batches(2, timezone=settings.TIME_ZONE))
+        self.assertEqual([ len(b) for b in batches ], [2, 2, 1])
+        self.assertEqual([ s.pk for b in batches for s in b ], [ s.pk for s in active ])
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushsend_sends_several_layouts_with_worker_pool(self):
+        for i in range(3):
+            _new_subscription_obj_for_test(True)
+        tasks = [ _new_task_obj_for_test(True, timezone.now()-timedelta(days=d)) \
+                  for d in (3, 4) ]
+        call_command('pushsend', stdout=StringIO())
+        for task in tasks:
+            task.refresh_from_db()
+            self.assertTrue(task.done_at is not None)
+    
+    def test_vapid_headers_cached_by_origin_until_expiry(self):
+        cache = VapidHeadersCache(
+            Vapid.from_string(private_key=VAPID_PRIVATE_KEY), VAPID_ADMIN_EMAIL
+        )
+        moz1 = cache.get('https://updates.push.services.mozilla.com/wpush/v2/aaa')
+        moz2 = cache.get('https://updates.push.services.mozilla.com/wpush/v2/bbb')
+        fcm = cache.get('https://fcm.googleapis.com/fcm/send/ccc')
+        self.assertIs(moz1, moz2)
+        self.assertNotEqual(moz1, fcm)
+        # expiry window is over
+        cache.evict(int(time.time()) + cache.LIFETIME)
+        moz3 = cache.get('https://updates.push.services.mozilla.com/wpush/v2/aaa')
+        self.assertIsNot(moz1, moz3)
+    
+    def test_bulk_errors_accounting(self):
+        ok = _new_subscription_obj_for_test(True)
+        ok.errors = 1
+        ok.save()
+        almost_dead = _new_subscription_obj_for_test(True)
+        almost_dead.errors = ERROR_THRESHOLD - 1
+        almost_dead.save()
+        gone = _new_subscription_obj_for_test(True)
+        fresh = _new_subscription_obj_for_test(True)
+        DigestSubscription.bulk_errors_accounting({
+            -1: [ok.pk, fresh.pk],
+            1: [almost_dead.pk],
+            15: [gone.pk],
+        })
+        for obj in (ok, almost_dead, gone, fresh):
+            obj.refresh_from_db()
+        self.assertEqual(ok.errors, 0)
+        self.assertEqual(fresh.errors, 0)
+        self.assertEqual(gone.errors, 15)
+        self.assertTrue(gone.is_active)
+        self.assertEqual(almost_dead.errors, ERROR_THRESHOLD)
+        self.assertFalse(almost_dead.is_active)
+        self.assertTrue(almost_dead.deactivated_at is not None)
+    
+    def test_bulk_errors_accounting_matches_per_object_accounting(self):
+        for status in (201, 301, 404, 410, 429, 503):
+            points, new_endpoint = DigestSubscription().push_service_response_error_points(status, '')
+            obj = _new_subscription_obj_for_test(True)
+            obj.errors = ERROR_THRESHOLD - 10
+            obj.save()
+            expected = DigestSubscription.objects.get(pk=obj.pk).errors_accounting(points)
+            DigestSubscription.bulk_errors_accounting({points: [obj.pk]} if points else {})
+            obj.refresh_from_db()
+            self.assertEqual(obj.errors, expected.errors)
+            self.assertEqual(obj.is_active, expected.is_active)
+    
+    def test_push_worker_keeps_configured_connection_pool(self):
+        init_push_worker('sync', 60, '', VAPID_PRIVATE_KEY, VAPID_ADMIN_EMAIL)
+        try:
+            session = sender._worker['session']
+            adapter = session.get_adapter('https://fcm.googleapis.com/fcm/send/x')
+            self.assertEqual(adapter._pool_maxsize, PUSHSEND_POOL_SIZE)
+            # unreachable push service doesn't break warm up
+            warm_push_worker(['https://127.0.0.1:1'])
+            self.assertIs(sender._worker['session'], session)
+        finally:
+            close_push_worker()
+    
+    @mock.patch('push.sender.PUSHSEND_BREAKER_ERRORS', 2)
+    def test_broken_endpoints_do_not_trip_circuit_breaker(self):
+        subscriptions = [ _new_subscription_obj_for_test(True) for i in range(3) ]
+        origin = sender.endpoint_origin(subscriptions[0].endpoint)
+        init_push_worker('sync', 60, '', VAPID_PRIVATE_KEY, VAPID_ADMIN_EMAIL)
+        try:
+            with mock.patch.object(sender._worker['session'], 'post',
+                                   side_effect=requests.exceptions.InvalidURL('test')):
+                responses, exceptions, deferred = sender.send_push_worker((subscriptions, '{}'))
+            self.assertEqual(len(exceptions), 3)
+            self.assertEqual(sender._worker['limiter'].paused_until(origin), 0)
+            
+            with mock.patch.object(sender._worker['session'], 'post',
+                                   side_effect=requests.exceptions.ConnectionError('test')):
+                sender.send_push_worker((subscriptions[:2], '{}'))
+            self.assertTrue(sender._worker['limiter'].paused_until(origin) > time.time())
+        finally:
+            close_push_worker()
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_send_shards_lease_heartbeat_and_takeover(self):
+        subscriptions = []
+        for i in range(3):
+            subscriptions.append(_new_subscription_obj_for_test(True))
+            # scattered among the others
+            _new_subscription_obj_for_test(False)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        tz_layout = task.timezonelayout_set.get(timezone=settings.TIME_ZONE)
+        SendShard.start_layout(tz_layout, 2)
+        SendShard.start_layout(tz_layout, 2)  # already started by someone else
+        shards = SendShard.objects.filter(tz_layout=tz_layout).order_by('id_from')
+        ids = [ s.pk for s in subscriptions ]
+        self.assertEqual(list(shards.values_list('id_from', 'id_to')),
+                         [(ids[0], ids[2]), (ids[2], ids[2] + 1)])
+        # timezones without subscribers are done right away
+        empty_layout = task.timezonelayout_set.exclude(timezone=settings.TIME_ZONE)[0]
+        SendShard.start_layout(empty_layout, 2)
+        empty_layout.refresh_from_db()
+        self.assertTrue(empty_layout.done_at is not None)
+        
+        shard = SendShard.lease('node1', 60)
+        self.assertEqual(shard.leased_by, 'node1')
+        self.assertTrue(shard.heartbeat(60, last_id=subscriptions[0].pk))
+        # dead node: lease expired, another node takes the shard
+        SendShard.objects.filter(pk=shard.pk).update(leased_until=timezone.now()-timedelta(seconds=1))
+        taken = SendShard.lease('node2', 60)
+        self.assertEqual(taken.pk, shard.pk)
+        self.assertEqual(taken.last_id, subscriptions[0].pk)
+        self.assertFalse(shard.heartbeat(60))  # node1 lost it
+        
+        while True:
+            shard = SendShard.lease('node2', 60)
+            if shard is None:
+                break
+            shard.finish()
+        taken.finish()
+        tz_layout.refresh_from_db()
+        self.assertTrue(tz_layout.done_at is not None)
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushsend_management_command_sharded(self):
+        _new_subscription_obj_for_test(True)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        with mock.patch('push.management.commands.pushsend.PUSHSEND_SHARDED', True):
+            call_command('pushsend', stdout=StringIO())
+        task.refresh_from_db()
+        self.assertTrue(task.started_at is not None)
+        self.assertTrue(task.done_at is not None)
+        self.assertFalse(SendShard.objects.filter(done_at__isnull=True).exists())
+    
+    def test_pushsend_streams_results_by_chunks(self):
+        subscriptions = [ _new_subscription_obj_for_test(True) for i in range(5) ]
+        with mock.patch('push.management.commands.pushsend.PUSHSEND_RESULT_CHUNK', 2):
+            results = _pushsend_send_for_test(subscriptions)
+        chunks = [ len(responses) + len(exceptions) + len(deferred) \
+                   for responses, exceptions, deferred in results ]
+        self.assertEqual(chunks, [2, 2, 1])
+    
+    def test_origin_limiter_rate_retry_after_and_circuit_breaker(self):
+        origin = 'https://fcm.googleapis.com'
+        now = 1000.0
+        limiter = OriginLimiter(rate=2, breaker_errors=3, breaker_pause=60, max_wait=5)
+        # bucket of 2 tokens, then requests wait for their turn
+        self.assertEqual([ limiter.delay(origin, now) for i in range(4) ], [0, 0, 0.5, 1.0])
+        # Retry-After
+        limiter.response(origin, 429, {'retry-after': '3'}, now)
+        self.assertEqual(limiter.paused_until(origin), now + 3)
+        self.assertTrue(limiter.delay(origin, now) >= 3)
+        limiter.response(origin, 503, {'retry-after': '120'}, now)
+        self.assertIsNone(limiter.delay(origin, now))  # defer, too long to wait
+        # circuit breaker
+        other = 'https://updates.push.services.mozilla.com'
+        for i in range(3):
+            limiter.response(other, 500, {}, now)
+        self.assertEqual(limiter.paused_until(other), now + 60)
+        self.assertIsNone(limiter.delay(other, now + 1))
+        limiter.response(other, 201, {}, now + 61)
+        self.assertEqual(limiter.delay(other, now + 61), 0)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 1445412480)
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_retry_queue_backoff_and_deadline(self):
+        subscriptions = [ _new_subscription_obj_for_test(True) for i in range(3) ]
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        RetryPush.schedule(task, [ s.pk for s in subscriptions ], 86400, 60)
+        RetryPush.schedule(task, [subscriptions[0].pk], 86400, 60)  # no duplicates
+        self.assertEqual(RetryPush.objects.count(), 3)
+        # nothing is due yet
+        self.assertEqual(list(RetryPush.claim_due('node1', 100, 600)), [])
+        
+        RetryPush.objects.update(retry_at=timezone.now()-timedelta(seconds=1))
+        batches = list(RetryPush.claim_due('node1', 2, 600))
+        self.assertEqual([ len(b) for b in batches ], [2, 1])
+        # claimed, so other nodes don't get them
+        self.assertEqual(list(RetryPush.claim_due('node2', 100, 600)), [])
+        
+        retries = batches[0] + batches[1]
+        RetryPush.reschedule(retries, {subscriptions[0].pk}, 60, 5)
+        retry = RetryPush.objects.get()
+        self.assertEqual(retry.subscription_id, subscriptions[0].pk)
+        self.assertEqual(retry.attempts, 1)
+        self.assertTrue(retry.retry_at > timezone.now() + timedelta(seconds=100))
+        # next backoff does not fit before the deadline
+        RetryPush.reschedule([retry], {subscriptions[0].pk}, 86400, 5)
+        self.assertFalse(RetryPush.objects.exists())
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_deferred_retries_stay_in_retry_queue(self):
+        subscr = _new_subscription_obj_for_test(True)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        RetryPush.schedule(task, [subscr.pk], 86400, 60, retry_at=timezone.now())
+        
+        def send(subscr_list, payload):
+            yield ([], [], [ (s, time.time() + 3600) for s in subscr_list ])
+        
+        cmd = _pushsend_command_for_test()
+        with _fake_push_services_for_test(send):
+            cmd.send_retries()
+        self.assertEqual(cmd.deferred, [])
+        retry = RetryPush.objects.get(subscription=subscr, task=task)
+        self.assertEqual(retry.attempts, 1)
+        self.assertEqual(retry.claimed_by, '')
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_daemon_does_not_wait_for_deferred_pushes(self):
+        subscr = _new_subscription_obj_for_test(True)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        cmd = _pushsend_command_for_test()
+        cmd.deferred = [ (task, subscr, time.time() + 60) ]
+        with mock.patch('push.management.commands.pushsend.time.sleep') as sleep:
+            cmd.send_deferred(0)
+        sleep.assert_not_called()
+        self.assertEqual(cmd.deferred, [])
+        self.assertTrue(RetryPush.objects.filter(subscription=subscr, task=task).exists())
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushsend_sends_layouts_with_same_run_at_in_one_pass(self):
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        layouts = task.timezonelayout_set.all()
+        # somebody to send to in every timezone
+        TimezoneSubscribers.objects.bulk_create([
+            TimezoneSubscribers(timezone=tz, active=1) for tz in pytz.all_timezones_set
+        ])
+        # one pass per distinct UTC run time (a few dozens of them),
+        # not one per timezone
+        self.assertTrue(len(set( l.run_at for l in layouts )) < len(layouts))
+        # db clean-up lottery would recount the counters made above
+        with mock.patch.object(DigestSubscription, 'active_batches', return_value=iter([])) as batches, \
+             mock.patch('push.management.commands.pushsend.randint', return_value=1):
+            call_command('pushsend', stdout=StringIO())
+        self.assertEqual(batches.call_count, len(set( l.run_at for l in layouts )))
+        self.assertFalse(task.timezonelayout_set.filter(started_at__isnull=True).exists())
+        self.assertFalse(task.timezonelayout_set.filter(done_at__isnull=True).exists())
+        task.refresh_from_db()
+        self.assertTrue(task.done_at is not None)
+        self.assertTrue(task.run_for(with_microseconds=True) is not None)
+        # started by the first pass, not by the last one
+        self.assertEqual(task.started_at, min(
+            task.timezonelayout_set.values_list('started_at', flat=True)
+        ))
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushsend_writes_run_metrics(self):
+        subscriptions = [ _new_subscription_obj_for_test(True) for i in range(3) ]
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        
+        def send(subscr_list, payload):
+            yield ([ (s, sender.PushResponse(201, '', {}, 0.2)) for s in subscr_list[:2] ],
+                   [ (s, ValueError('test'), time.time()) for s in subscr_list[2:] ],
+                   [])
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'pushsend.prom')
+            with mock.patch('push.management.commands.pushsend.PUSHSEND_METRICS_FILE', path), \
+                 _fake_push_services_for_test(send):
+                call_command('pushsend', stdout=StringIO())
+                with open(path) as f:
+                    lines = f.read().splitlines()
+                # nothing to send, file keeps the last real run
+                call_command('pushsend', stdout=StringIO())
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), lines)
+            self.assertEqual(os.listdir(tmp_dir), ['pushsend.prom'])
+        
+        task.refresh_from_db()
+        self.assertTrue(task.done_at is not None)
+        self.assertIn('infopush_pushsend_pushes{result="201"} 2.0', lines)
+        self.assertIn('infopush_pushsend_pushes{result="exception"} 1.0', lines)
+        self.assertIn('infopush_pushsend_batches 1.0', lines)
+        self.assertTrue(any(
+            l.startswith('infopush_pushsend_layout_pushes{pass="0",task="%d",timezones="' % task.pk) \
+                and l.endswith('} 3.0') for l in lines
+        ))
+        self.assertTrue(any( l.startswith('infopush_pushsend_layout_seconds{pass="0",') for l in lines ))
+        origin = sender.endpoint_origin(subscriptions[0].endpoint)
+        self.assertIn('infopush_pushsend_push_latency_seconds_bucket{origin="%s",le="0.1"} 0.0' % origin, lines)
+        self.assertIn('infopush_pushsend_push_latency_seconds_bucket{origin="%s",le="0.25"} 2.0' % origin, lines)
+        self.assertIn('infopush_pushsend_push_latency_seconds_count{origin="%s"} 2.0' % origin, lines)
+        self.assertTrue(any( l.startswith('infopush_pushsend_phase_seconds{phase="db_fetch"} ') for l in lines ))
+    
+    def test_fake_push_service_answers_with_error_mix(self):
+        subscriptions = [ _new_subscription_obj_for_test(True) for i in range(20) ]
+        service = FakePushService(latency=0.001, errors=0.25, throttled=0.25, seed=1)
+        origin = service.start()
+        try:
+            for subscr in subscriptions:
+                subscr.endpoint = origin + '/wpush/' + str(subscr.pk)
+            with mock.patch('push.sender.PUSHSEND_MAX_WAIT', 0):
+                results = _pushsend_send_for_test(subscriptions)
+        finally:
+            service.stop()
+        statuses = [ r.status_code for chunk in results for s, r in chunk[0] ]
+        deferred = [ d for chunk in results for d in chunk[2] ]
+        self.assertFalse([ e for chunk in results for e in chunk[1] ])
+        # the first 429 pauses the origin, the rest is deferred
+        self.assertEqual(statuses[-1], 429)
+        self.assertEqual(len(statuses) + len(deferred), 20)
+        self.assertEqual(sum(service.responses.values()), len(statuses))
+        self.assertTrue(all( r.elapsed for chunk in results for s, r in chunk[0] ))
+        self.assertEqual(percentile(sorted([3, 1, 2, 5, 4]), 0.5), 3)
+        self.assertEqual(percentile([], 0.99), None)
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushseed_management_command(self):
+        call_command('pushseed', 300, seed=7, stdout=StringIO())
+        self.assertEqual(DigestSubscription.objects.count(), 300)
+        active = DigestSubscription.objects.filter(is_active=True)
+        self.assertTrue(100 < active.count() < 300)
+        self.assertFalse(active.filter(errors__gte=ERROR_THRESHOLD).exists())
+        self.assertTrue(
+            set(DigestSubscription.objects.values_list('timezone', flat=True)) \
+                <= set(DEFAULT_SPEC['timezones']) | {settings.TIME_ZONE}
+        )
+        self.assertEqual(sum(TimezoneSubscribers.objects.values_list('active', flat=True)),
+                         active.count())
+        self.assertEqual(Task.objects.filter(done_at__isnull=False).count(), 5)
+        self.assertEqual(Task.objects.filter(done_at__isnull=True).count(), 1)
+        self.assertTrue(TimezoneLayout.undone_objects.exists())
+        # the same seed makes the same dataset
+        endpoints = [ s.endpoint for chunk in PushseedCommand().subscriptions(
+            random.Random(7), DEFAULT_SPEC, 300
+        ) for s in chunk ]
+        self.assertEqual(len(set(endpoints)), 300)
+        self.assertEqual(
+            set(DigestSubscription.objects.values_list('endpoint', flat=True)), set(endpoints)
+        )
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_pushsend_daemon_sleeps_until_next_layout(self):
+        _new_subscription_obj_for_test(True)
+        due_task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        next_task = _new_task_obj_for_test(True, timezone.now()+timedelta(days=1))
+        next_run_at = next_task.timezonelayout_set.order_by('run_at')[0].run_at
+        sleeps = []
+        
+        def wait(until, token, stop=None):
+            sleeps.append(until)
+            os.kill(os.getpid(), signal.SIGTERM)  # stops after this pass
+            return False
+        
+        old_handler = signal.getsignal(signal.SIGTERM)
+        with mock.patch('push.wakeup.wait', side_effect=wait), \
+             mock.patch('push.management.commands.pushsend.PUSHSEND_DAEMON_MAX_SLEEP', 2 * 86400), \
+             _fake_push_services_for_test():
+            call_command('pushsend', daemon=True, stdout=StringIO())
+        self.assertEqual(signal.getsignal(signal.SIGTERM), old_handler)
+        self.assertEqual(sleeps, [next_run_at.timestamp()])
+        due_task.refresh_from_db()
+        self.assertTrue(due_task.done_at is not None)
+        
+        # saved task wakes sleeping daemon up
+        token = wakeup.token()
+        with self.captureOnCommitCallbacks(execute=True):
+            next_task.save()
+            # not until the transaction is committed
+            self.assertEqual(wakeup.token(), token)
+        with mock.patch('push.wakeup.POLL_INTERVAL', 0.01):
+            self.assertTrue(wakeup.wait(time.time() + 5, token))
+            self.assertFalse(wakeup.wait(time.time() + 0.05, wakeup.token()))
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_task_save_updates_layouts_in_bulk(self):
+        task = _new_task_obj_for_test(False, timezone.now()+timedelta(days=1))
+        self.assertEqual(task.timezonelayout_set.count(), len(pytz.all_timezones_set))
+        ids = set(task.timezonelayout_set.values_list('id', flat=True))
+        layout = task.timezonelayout_set.get(timezone=settings.TIME_ZONE)
+        self.assertEqual(layout.run_at, task.run_at)
+        
+        run_at = dict(task.timezonelayout_set.values_list('id', 'run_at'))
+        
+        # nothing has changed
+        task.save()
+        self.assertEqual(dict(task.timezonelayout_set.values_list('id', 'run_at')), run_at)
+        
+        task.run_at = task.run_at + timedelta(hours=1)
+        task.save()
+        layout.refresh_from_db()
+        self.assertEqual(layout.run_at, task.run_at)
+        # the same rows, updated in place, every one of them
+        new_run_at = dict(task.timezonelayout_set.values_list('id', 'run_at'))
+        self.assertEqual(set(new_run_at), ids)
+        self.assertTrue(all( new_run_at[pk] != run_at[pk] for pk in ids ))
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    def test_timezone_subscribers_counters_and_empty_layouts(self):
+        counter = lambda tz=settings.TIME_ZONE: TimezoneSubscribers.objects.get(timezone=tz).active
+        subscrs = [ _new_subscription_obj_for_test(True) for i in range(3) ]
+        _new_subscription_obj_for_test(False)
+        self.assertEqual(counter(), 3)
+        
+        subscrs[0].deactivate().save()
+        self.assertEqual(counter(), 2)
+        subscr = DigestSubscription.objects.get(pk=subscrs[1].pk)
+        subscr.timezone = 'Asia/Tokyo'
+        subscr.save()
+        self.assertEqual(counter(), 1)
+        self.assertEqual(counter('Asia/Tokyo'), 1)
+        DigestSubscription.bulk_errors_accounting({ ERROR_THRESHOLD: [subscr.pk] })
+        DigestSubscription.bulk_deactivate([ subscrs[2].pk ])
+        self.assertEqual(counter(), 0)
+        self.assertEqual(counter('Asia/Tokyo'), 0)
+        
+        # counters went wrong somehow
+        DigestSubscription.objects.filter(pk=subscrs[0].pk).update(is_active=True)
+        TimezoneSubscribers.recount()
+        self.assertEqual(counter(), 1)
+        
+        # only project's timezone has someone to send to, and Tokyo
+        # whose counter missed a bulk update
+        DigestSubscription.objects.filter(pk=subscrs[1].pk).update(is_active=True, timezone='Asia/Tokyo')
+        self.assertEqual(counter('Asia/Tokyo'), 0)
+        task = _new_task_obj_for_test(True, timezone.now()-timedelta(days=3))
+        finished = TimezoneLayout.finish_empty()
+        self.assertEqual(finished, len(pytz.all_timezones_set) - 2)
+        self.assertEqual(
+            set( l.timezone for l in TimezoneLayout.undone_objects.all() ),
+            {settings.TIME_ZONE, 'Asia/Tokyo'}
+        )
+        task.refresh_from_db()
+        self.assertTrue(task.started_at is not None)
+        self.assertTrue(task.done_at is None)
+    
+    @skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                "Other planners may prefer full scan of a tiny test table.")
+    def test_pushsend_query_uses_subscription_indexes(self):
+        for i in range(3):
+            _new_subscription_obj_for_test(True)
+        postgresql = connection.vendor == 'postgresql'
+        if postgresql:
+            # tiny test table is cheaper to read whole, make planner show
+            # what it does with a real one
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+                cursor.execute("SET enable_bitmapscan = off")
+        
+        def assert_index_range_scan(qs, index, condition):
+            plan = qs.explain()
+            if postgresql:
+                self.assertIn("Index Scan using %s" % index, plan)
+                self.assertRegex(plan, r"Index Cond: .*%s" % condition[0])
+            else:
+                self.assertIn("USING INDEX %s" % index, plan)
+                self.assertIn(condition[1], plan)
+        
+        try:
+            for filters in ({ 'timezone': settings.TIME_ZONE },
+                            { 'timezone__in': [settings.TIME_ZONE, 'UTC'] },):
+                qs = DigestSubscription.objects.filter(is_active=True, id__gt=1, **filters) \
+                                               .order_by('id')[:100]
+                assert_index_range_scan(qs, 'push_subscr_tz_id_if_active',
+                                        (r"\(id > 1\)", "id>?"))
+            # db clean-up
+            qs = DigestSubscription.objects.filter(
+                is_active=False, deactivated_at__lt=timezone.now()
+            )
+            assert_index_range_scan(qs, 'push_subscr_deact_if_inactive',
+                                    (r"\(deactivated_at < ", "deactivated_at<?"))
+        finally:
+            if postgresql:
+                with connection.cursor() as cursor:
+                    cursor.execute("RESET enable_seqscan")
+                    cursor.execute("RESET enable_bitmapscan")
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    @mock.patch('push.stats.STATS_FLUSH_INTERVAL', 60)
+    def test_notification_stats_are_buffered_and_flushed(self):
+        obj = _new_task_obj_for_test(True,
+                                     timezone.now()-timedelta(days=3),
+                                     timezone.now(), timezone.now())
+        for i in range(3):
+            response = self.client.get(reverse('push_notification_plus_one', args=['views', obj.id,]))
+            self.assertEqual(response.status_code, 200)
+        stats.count('closings', obj.id)
+        obj.refresh_from_db()
+        # the first one is written right away, the rest waits in cache
+        self.assertEqual((obj.views, obj.closings), (1, 0))
+        
+        # next time somebody flushes them
+        caches[CACHE].delete('push:stats:flushed:%d' % obj.id)
+        stats.flush_recent()
+        obj.refresh_from_db()
+        self.assertEqual((obj.views, obj.closings), (3, 1))
+        # counters are not written twice
+        caches[CACHE].delete('push:stats:flushed:%d' % obj.id)
+        stats.flush(obj.id)
+        obj.refresh_from_db()
+        self.assertEqual((obj.views, obj.closings), (3, 1))
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    @mock.patch('push.stats.STATS_FLUSH_INTERVAL', 60)  # no stats queries
+    def test_last_notification_is_cached_by_timezone(self):
+        url = reverse('push_last_notification')
+        self.assertEqual(self.client.get(url, {'timezone': 'Asia/Tokyo'}).status_code, 404)
+        with self.captureOnCommitCallbacks(execute=True):
+            obj = _new_task_obj_for_test(True,
+                                         timezone.now()-timedelta(days=3),
+                                         timezone.now(), timezone.now())
+        # task save dropped cached "nothing to show"
+        response = self.client.get(url, {'timezone': 'Asia/Tokyo'})
+        self.assertEqual(response.json()['notification']['title'], obj.title)
+        
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'timezone': 'Asia/Tokyo'})
+        self.assertEqual(response.json()['notification']['title'], obj.title)
+        # unknown timezone means default one
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'timezone': 'Mars/Olympus_Mons'})
+        self.assertEqual(response.json()['notification']['title'], obj.title)
+        
+        obj.title = 'new title'
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save()
+        response = self.client.get(url, {'timezone': 'Asia/Tokyo'})
+        self.assertEqual(response.json()['notification']['title'], 'new title')
+    
+    @skipUnless(settings.SITE_ID, "Can't generate push-task obj without sites framework.")
+    @mock.patch('push.stats.STATS_FLUSH_INTERVAL', 60)  # no stats queries
+    def test_show_notification_signed_redirect(self):
+        obj = _new_task_obj_for_test(True,
+                                     timezone.now()-timedelta(days=3),
+                                     timezone.now(), timezone.now())
+        url = obj.get_payload()['url']
+        target = obj.url_relative(add_querystring={'from': 'push'})
+        self.assertRedirects(self.client.get(url), target, fetch_redirect_response=False)
+        # no db for clicks (buffered clicks were written out by the first one)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertRedirects(response, target, fetch_redirect_response=False)
+        obj.refresh_from_db()
+        self.assertEqual(obj.clicks, 1)
+        
+        # signature is checked against task id and target
+        other = _new_task_obj_for_test(False)
+        response = self.client.get(
+            reverse('push_show_notification', args=[other.id,]) + '?' + url.split('?')[1]
+        )
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url.replace('to=', 'to=x'))
+        self.assertRedirects(response, target, fetch_redirect_response=False)
+        obj.refresh_from_db()
+        self.assertEqual(obj.clicks, 1)
+        
+        # expired link of deactivated task
+        Task.objects.filter(pk=obj.pk).update(is_active=False)
+        with mock.patch('push.views.CLICK_MAX_AGE', -1):
+            self.assertEqual(self.client.get(url).status_code, 404)
+    
+    def test_view_save_and_deactivate_touch_only_what_changed(self):
+        counter = lambda tz=settings.TIME_ZONE: TimezoneSubscribers.objects.get(timezone=tz).active
+        data = {
+            'endpoint': 'https://updates.push.services.mozilla.com/wpush/v1/resubscribe',
+            'timezone': 'Asia/Tokyo',
+        }
+        subscr_id = self.client.post(reverse('push_save'), data).json()['response']['id']
+        self.assertEqual(counter('Asia/Tokyo'), 1)
+        
+        # resubscribe with the same info is one SELECT
+        with self.assertNumQueries(1):
+            response = self.client.post(reverse('push_save'), data)
+        self.assertEqual(response.json()['response']['id'], subscr_id)
+        
+        # unknown timezone is a project's one
+        data['timezone'] = 'Mars/Olympus_Mons'
+        self.client.post(reverse('push_save'), data)
+        self.assertEqual(DigestSubscription.objects.get(pk=subscr_id).timezone, settings.TIME_ZONE)
+        self.assertEqual((counter('Asia/Tokyo'), counter()), (0, 1))
+        
+        self.client.post(reverse('push_deactivate'), data)
+        self.client.post(reverse('push_deactivate'), data)
+        self.assertEqual(counter(), 0)
+        self.assertFalse(DigestSubscription.objects.get(pk=subscr_id).is_active)
+        self.client.post(reverse('push_save'), data)
+        subscr = DigestSubscription.objects.get(pk=subscr_id)
+        self.assertTrue(subscr.is_active)
+        self.assertEqual(counter(), 1)
+    
+    def test_save_queue_saves_subscriptions_in_bulk(self):
+        endpoint = 'https://updates.push.services.mozilla.com/wpush/v1/queued'
+        deactivated = _new_subscription_obj_for_test(True)
+        with mock.patch('push.views.SAVE_QUEUE', True):
+            for i in range(3):
+                response = self.client.post(reverse('push_save'), {
+                    'endpoint': endpoint + str(i % 2),
+                    'timezone': 'Asia/Tokyo',
+                })
+                self.assertEqual(response.json()['response']['status'], 'queued')
+            self.client.post(reverse('push_save'), { 'endpoint': deactivated.endpoint, })
+        # unsubscribed after subscription was queued
+        deactivated.deactivate().save()
+        self.assertFalse(DigestSubscription.objects.filter(endpoint__startswith=endpoint).exists())
+        
+        self.assertEqual(save_queue.flush(), 4)
+        self.assertEqual(
+            DigestSubscription.objects.filter(endpoint__startswith=endpoint, is_active=True).count(), 2
+        )
+        self.assertEqual(TimezoneSubscribers.objects.get(timezone='Asia/Tokyo').active, 2)
+        deactivated.refresh_from_db()
+        self.assertFalse(deactivated.is_active)
+        # nothing is left
+        self.assertEqual(save_queue.flush(), 0)
+        
+        # queue is full
+        with mock.patch('push.save_queue.SAVE_QUEUE_SIZE', 0):
+            self.assertFalse(save_queue.put(endpoint, {}))
+    
+    def test_save_queue_keeps_unsubscription_of_queued_subscription(self):
+        endpoint = 'https://updates.push.services.mozilla.com/wpush/v1/tombstone'
+        saved = _new_subscription_obj_for_test(True)
+        with mock.patch('push.views.SAVE_QUEUE', True):
+            self.client.post(reverse('push_save'), { 'endpoint': endpoint, })
+            self.client.post(reverse('push_save'), { 'endpoint': saved.endpoint, })
+            # not in db yet
+            response = self.client.post(reverse('push_deactivate'), { 'endpoint': endpoint, })
+            self.assertEqual(response.json()['response']['status'], 'queued')
+            # nobody has queued it
+            response = self.client.post(reverse('push_deactivate'), { 'endpoint': endpoint + 'x', })
+            self.assertEqual(response.status_code, 404)
+            # other pushsend is saving the queue
+            caches[CACHE].add(save_queue.LOCK_KEY, True)
+            self.assertEqual(save_queue.flush(), 0)
+            caches[CACHE].delete(save_queue.LOCK_KEY)
+            self.assertEqual(save_queue.flush(), 3)
+            # queued while in db
+            self.client.post(reverse('push_save'), { 'endpoint': saved.endpoint, })
+            save_queue.put(saved.endpoint, None)
+            self.assertEqual(save_queue.flush(), 2)
+        
+        self.assertFalse(DigestSubscription.objects.filter(endpoint=endpoint).exists())
+        saved.refresh_from_db()
+        self.assertFalse(saved.is_active)
+    
+    def test_subscriptions_are_looked_up_by_endpoint_hash(self):
+        subscr = _new_subscription_obj_for_test(True)
+        self.assertEqual(len(subscr.endpoint_hash), 32)
+        self.assertEqual(DigestSubscription.by_endpoint(subscr.endpoint).get().pk, subscr.pk)
+        
+        new_endpoint = subscr.endpoint + 'canonical'
+        subscr.change_endpoint(new_endpoint)
+        self.assertEqual(DigestSubscription.by_endpoint(new_endpoint).get().pk, subscr.pk)
+        self.assertFalse(DigestSubscription.by_endpoint(new_endpoint[:-9]).exists())
+        
+        # endpoint is still unique
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                DigestSubscription.objects.create(endpoint=new_endpoint, timezone='UTC')
+        
+        # and has the only index (no LIKE one on PostgreSQL)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, DigestSubscription._meta.db_table
+            )
+        self.assertEqual(
+            len([ c for c in constraints.values() if c['columns'] == ['endpoint_hash'] ]), 1
+        )
+    
+    def test_pushexport_and_pushimport(self):
+        subscrs = [ _new_subscription_obj_for_test(True) for i in range(3) ]
+        _new_subscription_obj_for_test(False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ('subscriptions.csv.gz', 'subscriptions.jsonl',):
+                path = os.path.join(tmp_dir, name)
+                with mock.patch.object(PushexportCommand, 'DB_LIMIT', 2):
+                    call_command('pushexport', path, stderr=StringIO())
+                DigestSubscription.objects.all().delete()
+                
+                out = StringIO()
+                call_command('pushimport', path, stdout=out)
+                self.assertEqual(out.getvalue().strip(), "3 subscriptions imported, 0 skipped.")
+                self.assertEqual(
+                    set(DigestSubscription.objects.values_list('endpoint', 'timezone', 'is_active')),
+                    set( (s.endpoint, s.timezone, True) for s in subscrs )
+                )
+            
+            path = os.path.join(tmp_dir, 'bad.jsonl')
+            with open(path, 'w') as f:
+                f.write(json.dumps({ 'endpoint': subscrs[0].endpoint, 'timezone': 'Mars/Olympus_Mons' }) + '\n')
+                f.write(json.dumps({ 'endpoint': 'not an url', 'timezone': 'UTC' }) + '\n')
+            out = StringIO()
+            call_command('pushimport', path, stdout=out)
+            self.assertEqual(out.getvalue().strip(), "0 subscriptions imported, 2 skipped.")
@@ -4,7 +4,7 @@ from PIL import Image
 
 import logging
 
-from django.db import IntegrityError, connection
+from django.db import IntegrityError
 from django.http import JsonResponse, Http404, HttpResponse
 from django.views.decorators.cache import never_cache, cache_page
 from django.views.decorators.http import require_POST
@@ -14,12 +14,15 @@ from django.conf import settings
 from django.urls import reverse, NoReverseMatch
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
+from django.core import signing
 from django.contrib.staticfiles import finders
 from django.contrib.sites.shortcuts import get_current_site
 
 from .settings import FCM_SENDER_ID, GCM_URL, APP_ICON_URLS, USE_CSRF, \
-                      APP_BACKGROUND_COLOR, APP_THEME_COLOR
-from .models import DigestSubscription, Task, TimezoneLayout
+                      APP_BACKGROUND_COLOR, APP_THEME_COLOR, SAVE_QUEUE
+from .models import DigestSubscription, Task, TimezoneLayout, CLICK_SALT, \
+                    CLICK_MAX_AGE
+from . import stats, payload_cache, save_queue
 
 
 logger = logging.getLogger(__name__)
@@ -97,26 +100,31 @@ def _save(request):
     auth_secret = request.POST.get('auth_secret', '')
     
     timezone = request.POST.get('timezone')
-    if timezone not in pytz.all_timezones:
+    if timezone not in pytz.all_timezones_set:
         timezone = settings.TIME_ZONE
     
-    try:
-        subscr = DigestSubscription.objects.get(endpoint=endpoint)
-    except DigestSubscription.DoesNotExist:
-        subscr = DigestSubscription()
-        subscr.endpoint = endpoint
+    fields = {
+        'key': key,
+        'auth_secret': auth_secret,
+        'timezone': timezone,
+        'ua': ua,
+    }
+    # no id for queued subscription, it is saved by pushsend later
+    if SAVE_QUEUE and save_queue.put(endpoint, fields):
+        return JsonResponse({
+            'response': {
+                'status': 'queued',
+                'id': None,
+            }
+        })
+    
     # actualize info anyway
-    subscr.key = key
-    subscr.auth_secret = auth_secret
-    subscr.timezone = timezone
-    subscr.ua = ua
-    subscr.reactivate_if_needed()
-    subscr.save()
+    subscr_id = DigestSubscription.upsert(endpoint, **fields)
     
     return JsonResponse({
         'response': {
             'status': 'ok',
-            'id': subscr.pk,
+            'id': subscr_id,
         }
     })
 
@@ -139,15 +147,23 @@ def _deactivate(request):
     endpoint = request.POST.get('endpoint')
     
     try:
-        subscr = DigestSubscription.objects.get(endpoint=endpoint)
+        subscr_id = DigestSubscription.deactivate_endpoint(endpoint)
     except DigestSubscription.DoesNotExist:
+        # it may be still in the save queue, tombstone cancels it there
+        if SAVE_QUEUE and endpoint and save_queue.pending(endpoint) \
+                and save_queue.put(endpoint, None):
+            return JsonResponse({
+                'response': {
+                    'status': 'queued',
+                    'id': None,
+                }
+            })
         raise Http404
-    subscr.deactivate().save()
     
     return JsonResponse({
         'response': {
             'status': 'ok',
-            'id': subscr.pk,
+            'id': subscr_id,
         }
     })
 
@@ -166,45 +182,58 @@ def deactivate(request):
         return _deactivate(request)
 
 
-def _notification_plus_one(what, id):
-    """
-    Statistics function (using raw SQL for speed).
-    """
-    cursor = connection.cursor()
-    # what variable content is controlled in django routing
-    # no security threats here
-    cursor.execute("UPDATE %s SET %s=%s+1 WHERE id=%d" \
-                    % (Task._meta.db_table, what, what, int(id)))
-
-
 @never_cache
 def notification_plus_one(request, what, id):
     """
     View to count views/closings statistics for push task.
     """
-    _notification_plus_one(what, id)
+    stats.count(what, int(id))
     return HttpResponse(content='ok')
 
 
 @never_cache
 def last_notification(request):
     """
-    Payload of the last actual and active push task for default timezone
-    for old legacy push subscriptions what do not support payload encryption.
+    Payload of the last actual and active push task for subscriber's timezone
+    (or default one) for old legacy push subscriptions what do not support
+    payload encryption.
     """
-    try:
-        tz = TimezoneLayout.public_objects.filter(timezone=settings.TIME_ZONE)[0]
-    except IndexError:
+    tz = request.GET.get('timezone')
+    if tz not in pytz.all_timezones_set:
+        tz = settings.TIME_ZONE
+    
+    # every push makes all such subscribers ask us at once, so it's cached
+    cached = payload_cache.get(tz)
+    if cached is None:
+        try:
+            layout = TimezoneLayout.public_objects.select_related('task') \
+                                                  .filter(timezone=tz)[0]
+            cached = (layout.task.id, layout.task.get_payload())
+        except IndexError:
+            cached = (None, None)
+        payload_cache.set(tz, *cached)
+    task_id, payload = cached
+    if task_id is None:
         raise Http404
-    _notification_plus_one('views', tz.task.id)
-    return JsonResponse({ 'notification': tz.task.get_payload(), })
+    stats.count('views', task_id)
+    return JsonResponse({ 'notification': payload, })
 
 
 @never_cache
 def show_notification(request, id):
+    # notification urls carry signed redirect target, no need for db then
+    try:
+        task_id, target = signing.loads(request.GET.get('to', ''), salt=CLICK_SALT,
+                                        max_age=CLICK_MAX_AGE)
+    except (signing.BadSignature, ValueError, TypeError):
+        task_id = None
+    if task_id == int(id):
+        stats.count('clicks', task_id)
+        return redirect(target)
+    
     try:
         task = Task.public_objects.get(pk=id)
     except Task.DoesNotExist:
         raise Http404
-    _notification_plus_one('clicks', task.id)
+    stats.count('clicks', task.id)
     return redirect(task.url_relative(add_querystring={'from': 'push'}))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.cache import caches
+
+from .settings import CACHE
+
+
+# changes every time push tasks are saved, so pushsend daemon knows
+# that it's sending schedule could be out of date
+KEY = 'push:pushsend:wakeup'
+# seconds between KEY checks of sleeping pushsend daemon
+POLL_INTERVAL = 1.0
+
+
+def token():
+    """Current value of the wake up key (compare it with a later one)"""
+    return caches[CACHE].get(KEY)
+
+
+def notify():
+    """Push tasks have changed, sleeping pushsend daemon should wake up"""
+    cache = caches[CACHE]
+    try:
+        cache.incr(KEY)
+    except ValueError:
+        cache.add(KEY, 1, timeout=None)
+
+
+def wait(until, last_token, stop=None):
+    """
+    Sleeps until unix timestamp until or until somebody calls notify()
+    (after last_token was taken), whatever comes first. Works across
+    processes only if DJANGO_INFOPUSH_CACHE is shared by them.
+    
+    stop is a callable, sleep is over as soon as it returns True.
+    Returns True if woken up by notify().
+    """
+    while True:
+        now = time.time()
+        if now >= until or (stop is not None and stop()):
+            return False
+        time.sleep(min(POLL_INTERVAL, until - now))
+        if token() != last_token:
+            return True
@@ -11,7 +11,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 
 setuptools.setup(
     name='django_infopush',
-    version='1.8.1',
+    version='1.9',
     packages=setuptools.find_packages(),  # ['push'],
     include_package_data=True,
     license='MIT',
@@ -45,5 +45,8 @@ setuptools.setup(
         'pytz>=2022.4',
         'Pillow>=4.3.0',  # for dimensions on image upload
         'pywebpush>=1.9.3',  # payload encryption
-    ]
+    ],
+    extras_require={
+        'async': ['httpx[http2]>=0.23'],  # asyncio HTTP/2 pushsend engine
+    }
 )